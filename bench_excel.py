@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""ExcelProcessor 基准测试
+
+用法:
+    # 单元格清理：旧实现与新实现对比
+    python bench_excel.py clean --rows 100000
+    # read_file 解析：各查询类型、各规模的吞吐量和内存，保存基线并检查回退
+    python bench_excel.py parse --sizes 1000,10000,100000 --save-baseline baseline.json
+    python bench_excel.py parse --sizes 1000,10000,100000 --baseline baseline.json --threshold 0.2
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from datetime import datetime, timedelta
+
+import openpyxl
+
+from index import ExcelProcessor, normalize_text, normalize_date_text
+
+def legacy_clean_value(value):
+    """旧版 _clean_value：每个字符串依次尝试全部 DATE_FORMATS"""
+    if value is None:
+        return None
+
+    if isinstance(value, str):
+        value = re.sub(r'\s+', ' ', value).strip()
+        for fmt in ExcelProcessor.DATE_FORMATS:
+            try:
+                dt = datetime.strptime(value, fmt)
+                if ' ' in fmt:
+                    return dt.isoformat(sep=' ')
+                else:
+                    return dt.date().isoformat()
+            except ValueError:
+                continue
+
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+
+    return value
+
+def generate_rows(count, seed=0):
+    """生成 glcx 形态的行数据（与 iter_rows 读到的 values_only 元组一致）"""
+    rng = random.Random(seed)
+    stations = ['北京南', '上海虹桥', '广州南', '深圳北', '杭州东', '南京南', ' 武汉 ', '成都东']
+    seats = ['二等座', '一等座', '商务座', '硬卧', '软卧', '无座']
+    names = [f'乘客{i}' for i in range(2000)]
+    base = datetime(2024, 1, 1)
+    rows = []
+    for _ in range(count):
+        day = base + timedelta(days=rng.randrange(365), minutes=rng.randrange(1440))
+        fmt = rng.choice(ExcelProcessor.DATE_FORMATS)
+        rows.append((
+            '售票',
+            rng.choice(names),
+            '身份证',
+            f'1101011990{rng.randrange(10 ** 8):08d}',
+            day.strftime(fmt) if rng.random() < 0.8 else day,
+            day.strftime('%H:%M'),
+            f'G{rng.randrange(1, 9999)}',
+            rng.choice(stations),
+            rng.choice(stations),
+            f'{rng.randrange(1, 17):02d}',
+            rng.choice(seats),
+            f'{rng.randrange(1, 20):02d}{rng.choice("ABCDF")}',
+            float(rng.randrange(50, 2000)),
+        ))
+    return rows
+
+def bench_clean(rows):
+    """对比旧版逐格全格式尝试与按列分派的新实现"""
+    processor = ExcelProcessor()
+    columns = list(ExcelProcessor.COLUMN_MAPPING['glcx'])
+    date_flags = [column in ExcelProcessor.DATE_COLUMNS for column in columns]
+
+    start = time.perf_counter()
+    legacy = [[legacy_clean_value(value) for value in row] for row in rows]
+    legacy_seconds = time.perf_counter() - start
+
+    normalize_text.cache_clear()
+    normalize_date_text.cache_clear()
+    start = time.perf_counter()
+    current = [
+        [processor._clean_value(value, flag) for value, flag in zip(row, date_flags)]
+        for row in rows
+    ]
+    current_seconds = time.perf_counter() - start
+
+    # 日期列结果必须与旧实现一致
+    for old_row, new_row in zip(legacy, current):
+        for old, new, flag in zip(old_row, new_row, date_flags):
+            if flag and old != new:
+                raise AssertionError(f"日期列结果不一致: {old!r} != {new!r}")
+
+    return {
+        'rows': len(rows),
+        'legacy_seconds': round(legacy_seconds, 3),
+        'current_seconds': round(current_seconds, 3),
+        'speedup': round(legacy_seconds / current_seconds, 1) if current_seconds else None,
+        'cache': normalize_date_text.cache_info()._asdict(),
+    }
+
+# ====================== 合成工作簿 ======================
+STATIONS = ['北京南', '上海虹桥', '广州南', '深圳北', '杭州东', '南京南', '武汉', '成都东']
+SEATS = ['二等座', '一等座', '商务座', '硬卧', '软卧', '无座']
+# 空行和带空白噪声的文本所占比例
+BLANK_ROW_RATE = 0.02
+NOISE_RATE = 0.1
+
+def _noisy(rng, text, inner=True):
+    """随机加入首尾空白、连续空格和换行；inner=False 时只加首尾空白"""
+    if rng.random() >= NOISE_RATE:
+        return text
+    if inner and len(text) > 1 and rng.random() < 0.5:
+        middle = len(text) // 2
+        text = f'{text[:middle]}  {text[middle:]}'
+    return rng.choice(['  {}', '{}\t', ' {} ', '{}\n']).format(text)
+
+def _date_cell(rng, moment, with_time):
+    """日期列：80% 为混合格式的字符串，其余为 datetime 单元格"""
+    if rng.random() < 0.2:
+        return moment
+    formats = [fmt for fmt in ExcelProcessor.DATE_FORMATS if (' ' in fmt) == with_time]
+    return _noisy(rng, moment.strftime(rng.choice(formats)), inner=False)
+
+def _cell(rng, column, moment, names):
+    if column == '乘车日期':
+        return _date_cell(rng, moment, False)
+    if column in ('乘车时间', '售票时间'):
+        return _date_cell(rng, moment, True)
+    if column == '票价':
+        return float(rng.randrange(50, 2000))
+    if column == '姓名':
+        return _noisy(rng, rng.choice(names))
+    if column == '证件编号':
+        return f'1101011990{rng.randrange(10 ** 8):08d}'
+    if column in ('发站', '到站', '售票处'):
+        return _noisy(rng, rng.choice(STATIONS))
+    if column == '席别':
+        return _noisy(rng, rng.choice(SEATS))
+    if column == '车次':
+        return f'G{rng.randrange(1, 9999)}'
+    if column == '车厢号':
+        return f'{rng.randrange(1, 17):02d}'
+    if column == '座位号':
+        return f'{rng.randrange(1, 20):02d}{rng.choice("ABCDF")}'
+    if column == '证件类型':
+        return '身份证'
+    return _noisy(rng, f'{column}{rng.randrange(100)}')
+
+def generate_workbook(path, query_type, rows, seed=0):
+    """生成与门户导出结构一致的工作簿：表头随机取 COLUMN_MAPPING 中的别名，
+    另有一列不在映射中的备注列，数据中混有空行和空白噪声"""
+    rng = random.Random(f'{query_type}-{rows}-{seed}')
+    columns = list(ExcelProcessor.COLUMN_MAPPING[query_type])
+    headers = [rng.choice(ExcelProcessor.COLUMN_MAPPING[query_type][column]) for column in columns]
+    names = [f'乘客{i}' for i in range(2000)]
+    base = datetime(2024, 1, 1)
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(headers + ['备注'])
+    written = 0
+    while written < rows:
+        if rng.random() < BLANK_ROW_RATE:
+            sheet.append([None] * (len(columns) + 1))
+            continue
+        moment = base + timedelta(days=rng.randrange(365), minutes=rng.randrange(1440))
+        sheet.append([_cell(rng, column, moment, names) for column in columns] + [None])
+        written += 1
+    workbook.save(path)
+
+def workbook_path(workdir, query_type, rows, seed):
+    """按参数缓存生成的工作簿，重复运行时不必重新生成"""
+    path = os.path.join(workdir, f'bench_{query_type}_{rows}_{seed}.xlsx')
+    if not os.path.exists(path):
+        generate_workbook(path, query_type, rows, seed)
+    return path
+
+def stale_dimension_copy(path, stale_path, ref='A1'):
+    """复制工作簿，并把工作表声明的范围改为过时的 <dimension ref="A1"/>（部分导出工具会写出这样的文件）"""
+    with zipfile.ZipFile(path) as source, zipfile.ZipFile(stale_path, 'w', zipfile.ZIP_DEFLATED) as target:
+        for item in source.infolist():
+            data = source.read(item.filename)
+            if item.filename.startswith('xl/worksheets/sheet'):
+                text = data.decode('utf-8')
+                dimension = f'<dimension ref="{ref}" />'
+                if '<dimension' in text:
+                    text = re.sub(r'<dimension [^>]*/>', dimension, text, count=1)
+                else:
+                    text = text.replace('<sheetViews', dimension + '<sheetViews', 1)
+                data = text.encode('utf-8')
+            target.writestr(item, data)
+
+def check_stale_dimension(workdir, query_type, rows=200, seed=0):
+    """声明范围过时的工作簿必须读出与原工作簿相同的数据"""
+    path = workbook_path(workdir, query_type, rows, seed)
+    stale_path = os.path.join(workdir, f'bench_{query_type}_{rows}_{seed}_stale.xlsx')
+    stale_dimension_copy(path, stale_path)
+    processor = ExcelProcessor()
+    expected = processor.read_file(path, query_type)
+    actual = processor.read_file(stale_path, query_type)
+    if len(expected) != rows or actual != expected:
+        raise AssertionError(
+            f"{query_type} 过时的 <dimension> 导致读取结果不一致: {len(actual)} 行，应为 {rows} 行"
+        )
+
+# ====================== read_file 基准 ======================
+def _snapshot():
+    """tracemalloc 快照，排除 tracemalloc 自身的分配"""
+    return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+
+def bench_parse(path, query_type, rows):
+    """先不开 tracemalloc 计时，再单独运行一次统计峰值内存和解析新增的分配块数（与解析前的快照对比）"""
+    processor = ExcelProcessor()
+    normalize_text.cache_clear()
+    normalize_date_text.cache_clear()
+    start = time.perf_counter()
+    result = processor.read_file(path, query_type)
+    seconds = time.perf_counter() - start
+    if len(result) != rows:
+        raise AssertionError(f"{query_type} 解析行数不符: {len(result)} != {rows}")
+    del result
+
+    normalize_text.cache_clear()
+    normalize_date_text.cache_clear()
+    tracemalloc.start()
+    try:
+        before = _snapshot()
+        result = processor.read_file(path, query_type)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        allocated_blocks = sum(
+            stat.count_diff for stat in _snapshot().compare_to(before, 'filename') if stat.count_diff > 0
+        )
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {
+        'rows': rows,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(rows / seconds, 1) if seconds else None,
+        'peak_bytes': peak_bytes,
+        'allocated_blocks': allocated_blocks,
+    }
+
+def check_regressions(results, baseline, threshold):
+    """与基线对比：吞吐量下降、峰值内存或新增分配块上升超过阈值即视为回退"""
+    failures = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        if current['rows_per_second'] < previous['rows_per_second'] * (1 - threshold):
+            failures.append(
+                f"{key}: 吞吐量 {current['rows_per_second']} 行/秒 低于基线 {previous['rows_per_second']}"
+            )
+        if current['peak_bytes'] > previous['peak_bytes'] * (1 + threshold):
+            failures.append(
+                f"{key}: 峰值内存 {current['peak_bytes']} 字节 高于基线 {previous['peak_bytes']}"
+            )
+        # 旧基线没有分配块数时跳过
+        if 'allocated_blocks' in previous and current['allocated_blocks'] > previous['allocated_blocks'] * (1 + threshold):
+            failures.append(
+                f"{key}: 新增分配块 {current['allocated_blocks']} 高于基线 {previous['allocated_blocks']}"
+            )
+    return failures
+
+def run_clean(args):
+    result = bench_clean(generate_rows(args.rows))
+    print(f"行数: {result['rows']}")
+    print(f"旧实现: {result['legacy_seconds']} 秒")
+    print(f"新实现: {result['current_seconds']} 秒 (加速 {result['speedup']} 倍)")
+    print(f"日期缓存: {result['cache']}")
+
+def run_parse(args):
+    query_types = [qt.strip() for qt in args.types.split(',') if qt.strip()]
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    workdir = args.workdir or tempfile.gettempdir()
+    os.makedirs(workdir, exist_ok=True)
+
+    for query_type in query_types:
+        check_stale_dimension(workdir, query_type)
+    print("过时 <dimension> 声明检查通过")
+
+    results = {}
+    for query_type in query_types:
+        for rows in sizes:
+            path = workbook_path(workdir, query_type, rows, args.seed)
+            result = results[f'{query_type}/{rows}'] = bench_parse(path, query_type, rows)
+            print(
+                f"{query_type:>6} {rows:>8} 行: {result['seconds']:>8} 秒, "
+                f"{result['rows_per_second']:>10} 行/秒, 峰值 {result['peak_bytes'] / 1024 / 1024:.1f} MB, "
+                f"新增分配块 {result['allocated_blocks']}"
+            )
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存到 {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        failures = check_regressions(results, baseline, args.threshold)
+        for failure in failures:
+            print(f"回退: {failure}")
+        if failures:
+            sys.exit(1)
+        print(f"与基线相比未超过 {args.threshold:.0%} 的回退阈值")
+
+def main():
+    parser = argparse.ArgumentParser(description='ExcelProcessor 基准测试')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    clean = commands.add_parser('clean', help='单元格清理：旧实现与新实现对比')
+    clean.add_argument('--rows', type=int, default=100000, help='生成的行数')
+    clean.set_defaults(func=run_clean)
+
+    parse = commands.add_parser('parse', help='read_file 解析吞吐量和内存')
+    parse.add_argument('--types', default=','.join(ExcelProcessor.COLUMN_MAPPING), help='逗号分隔的查询类型')
+    parse.add_argument('--sizes', default='1000,10000,100000', help='逗号分隔的行数，最大可到 1000000')
+    parse.add_argument('--seed', type=int, default=0)
+    parse.add_argument('--workdir', help='生成的工作簿存放目录（默认系统临时目录，重复运行时复用）')
+    parse.add_argument('--save-baseline', help='把结果保存为基线 JSON')
+    parse.add_argument('--baseline', help='与该基线 JSON 对比，回退时以非零状态退出')
+    parse.add_argument('--threshold', type=float, default=0.2, help='允许的回退比例')
+    parse.set_defaults(func=run_parse)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
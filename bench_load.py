@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""查询接口端到端压测，输出吞吐量、延迟分位数和峰值内存（JSON）
+
+用法:
+    # 自动启动模拟门户和服务，压测结束后关闭
+    python bench_load.py --spawn --concurrency 8 --requests 200 --output result.json
+    # 压测已运行的服务
+    python bench_load.py --base-url http://127.0.0.1:5000 --types glcx,zzcx
+"""
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+QUERY_TYPES = ('glcx', 'zzcx', 'plgjcx')
+STATIONS = ['北京南', '上海虹桥', '广州南', '深圳北']
+
+def _random_id(rng):
+    return f'1101011990{rng.randrange(10 ** 8):08d}'
+
+def build_payload(query_type, rng, batch_size):
+    """生成与各查询路由请求体格式一致的随机参数"""
+    start = date(2024, 1, 1) + timedelta(days=rng.randrange(300))
+    end = start + timedelta(days=rng.randrange(1, 30))
+    if query_type == 'glcx':
+        return [{
+            'date_start': start.isoformat(),
+            'date_end': end.isoformat(),
+            'id_no': _random_id(rng),
+        } for _ in range(batch_size)]
+    if query_type == 'zzcx':
+        return [{
+            'train_date': start.isoformat(),
+            'train_code': f'G{rng.randrange(1, 9999)}',
+            'from_station': rng.choice(STATIONS),
+            'to_station': rng.choice(STATIONS),
+        } for _ in range(batch_size)]
+    return {
+        'date_start': start.isoformat(),
+        'date_end': end.isoformat(),
+        'id_no_list': [_random_id(rng) for _ in range(batch_size)],
+    }
+
+def _count_rows(query_type, data):
+    if query_type == 'plgjcx':
+        return len(data)
+    return sum(len(rows) for rows in data)
+
+def send(base_url, query_type, payload, use_cache, timeout):
+    """发送一次查询请求，返回 (耗时秒数, 是否成功, 行数)"""
+    headers = {'Content-Type': 'application/json'}
+    if not use_cache:
+        headers['Cache-Control'] = 'no-cache'
+    req = urllib.request.Request(
+        f'{base_url}/cyber/{query_type}',
+        data=json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+        headers=headers,
+        method='POST'
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            body = json.loads(response.read().decode('utf-8'))
+        ok = body.get('code') == 900
+        rows = _count_rows(query_type, body['data']) if ok else 0
+    except (urllib.error.URLError, OSError, ValueError):
+        ok, rows = False, 0
+    return time.perf_counter() - started, ok, rows
+
+def percentile(sorted_values, fraction):
+    """最近秩法分位数"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(fraction * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+def summarize(samples, duration):
+    latencies = sorted(latency for latency, _, _ in samples)
+    ms = lambda value: round(value * 1000, 1) if value is not None else None
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for _, ok, _ in samples if not ok),
+        'rows': sum(rows for _, _, rows in samples),
+        'throughput_rps': round(len(samples) / duration, 3) if duration else None,
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 0.50)),
+            'p95': ms(percentile(latencies, 0.95)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'mean': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+class RssSampler:
+    """定期采样被测进程及其子进程（浏览器）的总 RSS，记录峰值"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        process = psutil.Process(self.pid)
+        total = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                continue
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.peak = max(self.peak or 0, self._sample())
+            except psutil.Error:
+                return
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if psutil is not None and self.pid:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+def _wait_ready(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=2):
+                return
+        except urllib.error.HTTPError:
+            # 服务已响应（即使是错误码）即视为就绪
+            return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.5)
+    raise RuntimeError(f'等待 {url} 就绪超时')
+
+def spawn(args):
+    """启动模拟门户和服务进程"""
+    portal = subprocess.Popen([
+        sys.executable, os.path.join(HERE, 'mock_portal.py'),
+        '--port', str(args.portal_port),
+        '--rows', str(args.portal_rows),
+        '--query-latency', str(args.portal_latency),
+        '--export-latency', str(args.portal_latency),
+    ])
+    env = dict(
+        os.environ,
+        PORTAL_BASE_URL=f'http://127.0.0.1:{args.portal_port}/rntibp',
+        BROWSER_HEADLESS='1',
+    )
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, 'index.py')], env=env)
+    try:
+        _wait_ready(f'http://127.0.0.1:{args.portal_port}/rntibp/login.html', 30)
+        _wait_ready(f'{args.base_url}/cyber/cache', 60)
+    except Exception:
+        stop([portal, server])
+        raise
+    return [portal, server]
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+def run(args, server_pid=None):
+    """按并发数发送请求，返回汇总结果"""
+    rng = random.Random(args.seed)
+    types = [query_type.strip() for query_type in args.types.split(',') if query_type.strip()]
+    plan = [
+        (query_type, build_payload(query_type, rng, args.batch_size))
+        for query_type in (types[idx % len(types)] for idx in range(args.requests))
+    ]
+
+    def one(item):
+        query_type, payload = item
+        latency, ok, rows = send(args.base_url, query_type, payload, args.use_cache, args.timeout)
+        return query_type, (latency, ok, rows)
+
+    with RssSampler(server_pid) as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(one, plan))
+        duration = time.perf_counter() - started
+
+    samples = [sample for _, sample in results]
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'base_url': args.base_url,
+            'types': types,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'batch_size': args.batch_size,
+            'use_cache': args.use_cache,
+        },
+        'duration_seconds': round(duration, 3),
+        **summarize(samples, duration),
+        'by_type': {
+            query_type: summarize([sample for qt, sample in results if qt == query_type], duration)
+            for query_type in types
+        },
+        'peak_rss_bytes': sampler.peak,
+    }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='查询接口端到端压测')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--types', default=','.join(QUERY_TYPES), help='逗号分隔的查询类型，按顺序轮流发送')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=100, help='请求总数')
+    parser.add_argument('--batch-size', type=int, default=1, help='每个请求的条目数（plgjcx 为证件号数）')
+    parser.add_argument('--use-cache', action='store_true', help='允许命中服务端结果缓存')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pid', type=int, help='被测服务进程号，用于采样峰值 RSS（需要 psutil）')
+    parser.add_argument('--spawn', action='store_true', help='自动启动 mock_portal.py 和 index.py')
+    parser.add_argument('--portal-port', type=int, default=9943)
+    parser.add_argument('--portal-rows', type=int, default=100)
+    parser.add_argument('--portal-latency', type=float, default=0.0)
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    processes = spawn(args) if args.spawn else []
+    try:
+        report = run(args, server_pid=processes[1].pid if processes else args.pid)
+    finally:
+        stop(processes)
+
+    if report['peak_rss_bytes'] is None and processes and resource is not None:
+        # 没有 psutil 时退回到已回收子进程的最大 RSS（Linux 上单位为 KB）
+        report['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,37 @@
 # -*- coding: utf-8 -*-
+import argparse
 import asyncio
+import atexit
 import threading
 import traceback
 import logging
-import tempfile
+import time
 import os
+import io
 import uuid
 import random
 import re
 import json
+import contextvars
+import queue
+import calendar
 import openpyxl
 import pyautogui
 import pygetwindow as gw
-from functools import wraps
-from datetime import datetime
-from flask import Flask, request, jsonify, make_response
-from playwright.async_api import async_playwright
+from functools import wraps, lru_cache
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import MappingProxyType, SimpleNamespace
+from operator import itemgetter
+from urllib.parse import quote, quote_plus, urlsplit
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from datetime import datetime, date, timedelta
+from flask import Flask, Response, request, jsonify, make_response
+from flask.globals import request_ctx
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from response_format import render, dumps_json
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 
 app = Flask(__name__)
 app.config['JSON_AS_ASCII'] = False
@@ -24,10 +40,214 @@ logger = logging.getLogger('AutomationServer')
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-# 线程局部存储
-_thread_local = threading.local()
+# ====================== 配置 ======================
+# 门户地址，压测时可指向本地模拟门户（mock_portal.py）
+PORTAL_BASE_URL = os.environ.get('PORTAL_BASE_URL', 'https://10.3.2.201:9943/rntibp').rstrip('/')
+# 是否以无界面模式启动浏览器（本地压测或服务器环境）
+BROWSER_HEADLESS = os.environ.get('BROWSER_HEADLESS', '0') == '1'
+_portal = urlsplit(PORTAL_BASE_URL)
+PORTAL_ORIGIN = f'{_portal.scheme}://{_portal.netloc}'
+# 登录会话的默认有效期（秒），未从cookie观察到过期时间时使用
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 1800))
+# 在会话过期前提前多少秒主动重新登录
+SESSION_REFRESH_MARGIN = int(os.environ.get('SESSION_REFRESH_MARGIN', 120))
+# 门户会话cookie的名称（逗号分隔），只按这些cookie的过期时间估算会话寿命；登录后没有这些cookie时考虑门户域名下的全部cookie
+SESSION_COOKIE_NAMES = frozenset(
+    name.strip() for name in os.environ.get('SESSION_COOKIE_NAMES', 'JSESSIONID').split(',') if name.strip()
+)
+# 同时打开的查询页面（浏览器上下文）上限
+CONTEXT_POOL_SIZE = int(os.environ.get('CONTEXT_POOL_SIZE', 4))
+# 预热时各查询类型打开的页面数，如 glcx:2,zzcx:1,plgjcx:1；未设置时按查询类型轮流分配池容量
+# 启动时由 parse_prewarm_pages 解析并校验为 PREWARM_COUNTS
+PREWARM_PAGES = os.environ.get('PREWARM_PAGES', '')
+# 保活任务的执行间隔（秒，0 表示不启用）：请求门户保持会话活跃、提前刷新会话、回收过旧页面
+KEEPALIVE_INTERVAL = int(os.environ.get('KEEPALIVE_INTERVAL', 300))
+# 池中页面的最长存活时间（秒，0 表示不限制），超过后关闭重建，避免 Chromium 内存持续增长
+PAGE_MAX_AGE = int(os.environ.get('PAGE_MAX_AGE', 1800))
+# 是否启用直接请求导出接口的快速通道（失败时回退到页面点击）
+FAST_PATH_ENABLED = os.environ.get('FAST_PATH_ENABLED', '1') == '1'
+# xlsx 解析方式：process 进程池（多核并行）、thread 线程池、inline 在事件循环中直接解析
+PARSE_EXECUTOR = os.environ.get('PARSE_EXECUTOR', 'process')
+# 解析进程（线程）数
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', min(4, os.cpu_count() or 1)))
+# 单元格文本规范化结果的缓存条数（日期、站名、席别等重复值）
+VALUE_CACHE_SIZE = int(os.environ.get('VALUE_CACHE_SIZE', 65536))
+# 查询结果缓存：各查询类型的有效期（秒，0 表示不缓存）及容量上限
+RESULT_CACHE_TTL = {
+    'glcx': int(os.environ.get('RESULT_CACHE_TTL_GLCX', 300)),
+    'zzcx': int(os.environ.get('RESULT_CACHE_TTL_ZZCX', 300)),
+    'plgjcx': int(os.environ.get('RESULT_CACHE_TTL_PLGJCX', 0)),
+}
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 1024))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# plgjcx 每个分片上传的证件号数量，分片在不同的上下文中并发执行
+PLGJCX_SHARD_SIZE = int(os.environ.get('PLGJCX_SHARD_SIZE', 500))
+# 日期范围长于 N 个月时按自然月拆分为并发的子查询，值为每个子查询的月数 N（0 表示不拆分），3 即按季度对齐
+DATE_SPLIT_MONTHS = {
+    'glcx': int(os.environ.get('DATE_SPLIT_MONTHS_GLCX', 1)),
+    'plgjcx': int(os.environ.get('DATE_SPLIT_MONTHS_PLGJCX', 1)),
+}
+
+# 操作节奏：fast 只等待页面条件；human 模拟人工操作（slow_mo 和点击前随机停顿）
+PACING_PROFILES = {
+    'fast': {'slow_mo': 0, 'click_delay': (0, 0), 'settle_ms': 0},
+    'human': {'slow_mo': 1000, 'click_delay': (0.2, 0.5), 'settle_ms': 300},
+}
+PACING = PACING_PROFILES[os.environ.get('PACING_PROFILE', 'fast')]
+# 点击 #queryBtn 后等待查询结果（确认框中的 #confirmBtn 可见且可用）的时间（毫秒）
+QUERY_RESPONSE_TIMEOUT = int(os.environ.get('QUERY_RESPONSE_TIMEOUT', 30000))
+# 资源拦截：在浏览器上下文中中止非必要请求（图片、字体、统计埋点等）
+# 注意 Playwright 注册任何路由后都会停用该上下文的 HTTP 缓存，放行的脚本、样式表在每个新页面和每次登录时都会重新下载
+RESOURCE_BLOCKING_ENABLED = os.environ.get('RESOURCE_BLOCKING_ENABLED', '1') == '1'
+# 直接中止的资源类型；样式表默认放行，设置 BLOCK_STYLESHEETS=1 时一并拦截
+BLOCKED_RESOURCE_TYPES = frozenset(
+    ['image', 'font', 'media', 'texttrack', 'manifest']
+    + (['stylesheet'] if os.environ.get('BLOCK_STYLESHEETS', '0') == '1' else [])
+)
+# 直接中止的 URL（正则），用于统计分析、埋点等第三方请求
+BLOCKED_URL_PATTERN = re.compile(os.environ.get(
+    'BLOCKED_URL_PATTERN',
+    r'google-analytics\.com|googletagmanager\.com|hm\.baidu\.com|cnzz\.com|growingio\.com|sentry\.io'
+))
+# 登录页允许加载的脚本（正则）；各查询页的脚本白名单见 QueryPlan.scripts
+LOGIN_SCRIPTS = (f'^{re.escape(PORTAL_ORIGIN)}/',)
+# 等待 Windows 数字证书弹窗出现的时间（秒）
+CERT_POPUP_TIMEOUT = float(os.environ.get('CERT_POPUP_TIMEOUT', 5))
+
+# 异步任务：并发执行的任务数，以及完成后结果保留的时间（秒）
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 3600))
+
+# 耗时直方图的分桶上限（秒）
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# 当前请求是否跳过结果缓存（Cache-Control: no-cache）
+cache_bypass = contextvars.ContextVar('cache_bypass', default=False)
+# 当前正在执行的异步任务，用于上报进度
+current_job = contextvars.ContextVar('current_job', default=None)
+
+# ====================== 指标 ======================
+class Metrics:
+    """进程内的计数器和耗时直方图，按 Prometheus 文本格式输出"""
+    HELP = {
+        'cyber_stage_seconds': ('histogram', '各阶段耗时（秒）'),
+        'cyber_pool_wait_seconds': ('histogram', '等待页面池借出页面的耗时（秒）'),
+        'cyber_parse_seconds': ('histogram', '解析进程中实际解析导出文件的耗时（秒）'),
+        'cyber_timeouts_total': ('counter', '各阶段超时次数'),
+        'cyber_retries_total': ('counter', '查询重试及回退次数'),
+        'cyber_cache_requests_total': ('counter', '结果缓存查找次数'),
+    }
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        """记录一次直方图观测值"""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][idx] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def inc(self, name, amount=1, **labels):
+        """计数器加一"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def span(self, stage, query_type='-'):
+        """统计一个阶段的耗时；outcome 按异常自动判定，也可由调用方改写"""
+        span = SimpleNamespace(outcome='ok')
+        started = time.perf_counter()
+        try:
+            yield span
+        except (asyncio.TimeoutError, PlaywrightTimeoutError):
+            span.outcome = 'timeout'
+            raise
+        except asyncio.CancelledError:
+            span.outcome = 'cancelled'
+            raise
+        except Exception:
+            span.outcome = 'error'
+            raise
+        finally:
+            self.observe(
+                'cyber_stage_seconds', time.perf_counter() - started,
+                stage=stage, query_type=query_type, outcome=span.outcome
+            )
+            if span.outcome == 'timeout':
+                self.inc('cyber_timeouts_total', stage=stage, query_type=query_type)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+            for name, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self, gauges=()):
+        """输出 Prometheus 文本格式；gauges 为采集时计算的 (名称, 类型, 说明, 标签, 值)"""
+        with self._lock:
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+
+        series = {}
+        for (name, labels), value in counters.items():
+            series.setdefault(name, []).append(f'{name}{self._format_labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in histograms.items():
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{self._format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{self._format_labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{self._format_labels(labels)} {total:.6f}')
+            lines.append(f'{name}_count{self._format_labels(labels)} {count}')
+
+        help_text = dict(self.HELP)
+        for name, metric_type, description, labels, value in gauges:
+            help_text[name] = (metric_type, description)
+            series.setdefault(name, []).append(f'{name}{self._format_labels(sorted(labels.items()))} {value}')
+
+        output = []
+        for name in sorted(series):
+            metric_type, description = help_text.get(name, ('untyped', name))
+            output.append(f'# HELP {name} {description}')
+            output.append(f'# TYPE {name} {metric_type}')
+            output.extend(sorted(series[name]) if metric_type != 'histogram' else series[name])
+        return '\n'.join(output) + '\n'
+
+metrics = Metrics(METRICS_BUCKETS)
 
 # ====================== Excel 处理工具 ======================
+def _build_alias_index(column_mapping):
+    """构建 查询类型 -> {别名: 标准列名} 的反向索引"""
+    alias_index = {}
+    for query_type, columns in column_mapping.items():
+        index = alias_index[query_type] = {}
+        for col_name, aliases in columns.items():
+            for alias in aliases:
+                index.setdefault(alias, col_name)
+    return alias_index
+
 class ExcelProcessor:
     COLUMN_MAPPING = {
         'glcx': {
@@ -93,25 +313,22 @@ class ExcelProcessor:
         '%Y%m%d %H:%M'
     ]
     
-    def _clean_value(self, value):
+    # 导入时构建一次的别名反向索引
+    ALIAS_INDEX = _build_alias_index(COLUMN_MAPPING)
+    
+    # 只有这些列会尝试日期解析，其余文本列只做空白规范化
+    DATE_COLUMNS = frozenset(['乘车日期', '乘车时间', '售票时间'])
+    
+    def _clean_value(self, value, parse_dates=True):
         """清理和转换Excel值"""
         if value is None:
             return None
             
         if isinstance(value, str):
-            # 移除不可见字符和多余空格
-            value = re.sub(r'\s+', ' ', value).strip()
-            
-            # 尝试转换日期格式
-            for fmt in self.DATE_FORMATS:
-                try:
-                    dt = datetime.strptime(value, fmt)
-                    if ' ' in fmt:
-                        return dt.isoformat(sep=' ')
-                    else:
-                        return dt.date().isoformat()
-                except ValueError:
-                    continue
+            # 移除不可见字符和多余空格，并尝试转换日期格式
+            if parse_dates:
+                return normalize_date_text(value)
+            return normalize_text(value)
         
         # 如果是datetime对象，转换为字符串
         if isinstance(value, datetime):
@@ -126,113 +343,989 @@ class ExcelProcessor:
             return []
             
         try:
-            return self._read_excel(file_path, query_type)
+            return list(self.iter_rows(file_path, query_type))
         except Exception as e:
             logger.error(f"读取文件 {file_path} 时出错: {str(e)}")
             logger.debug(traceback.format_exc())
             return []
 
-    def _read_excel(self, file_path, query_type):
-        """读取特定类型的Excel文件"""
+    def read_bytes(self, data, query_type):
+        """从内存中的xlsx内容读取结构化数据，不落盘"""
+        try:
+            return list(self.iter_rows(io.BytesIO(data), query_type))
+        except Exception as e:
+            logger.error(f"读取 {query_type} 导出内容时出错: {str(e)}")
+            logger.debug(traceback.format_exc())
+            return []
+
+    def _compile_extractor(self, header_row, query_type):
+        """根据标题行编译行提取器，返回 (标准列名列表, 提取函数)"""
+        alias_index = self.ALIAS_INDEX[query_type]
+        
+        # 同一标准列出现多次时以最后一列为准
+        column_index_map = {}
+        for idx, header in enumerate(header_row):
+            col_name = alias_index.get(header) if header is not None else None
+            if col_name is not None:
+                column_index_map[col_name] = idx
+        
+        columns = list(self.COLUMN_MAPPING[query_type])
+        missing_columns = [col_name for col_name in columns if col_name not in column_index_map]
+        if missing_columns:
+            logger.warning(f"缺少列: {', '.join(missing_columns)}，将返回空值")
+        
+        # 缺失列统一指向行尾之后的填充位置，取值为 None
+        pad_index = len(header_row)
+        indices = [column_index_map.get(col_name, pad_index) for col_name in columns]
+        width = max(indices) + 1
+        padding = (None,) * width
+        getter = itemgetter(*indices)
+        if len(indices) == 1:
+            single_getter = getter
+            getter = lambda row: (single_getter(row),)
+        
+        def extract(row):
+            if len(row) < width:
+                row = tuple(row) + padding[len(row):]
+            return getter(row)
+        
+        return columns, extract
+
+    def iter_rows(self, source, query_type):
+        """以只读流式模式逐行产出清理后的数据（路径或文件对象），内存占用与导出大小无关"""
+        columns = list(self.COLUMN_MAPPING.get(query_type, ()))
+        for values in self.iter_values(source, query_type):
+            yield dict(zip(columns, values))
+
+    def iter_values(self, source, query_type):
+        """与 iter_rows 相同，但按 COLUMN_MAPPING 的列顺序产出值元组，便于跨进程传递"""
         if query_type not in self.COLUMN_MAPPING:
             logger.error(f"未知的查询类型: {query_type}")
-            return []
+            return
             
-        # 获取列映射
-        column_map = self.COLUMN_MAPPING[query_type]
-        data = []
-        
+        # 只读模式按需解析工作表XML，不构建完整的单元格对象模型
+        workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
         try:
-            workbook = openpyxl.load_workbook(file_path, data_only=True)
             worksheet = workbook.active
             
-            # 记录读取进度
+            # 记录读取进度（只读模式下行数来自工作表声明的范围，可能缺失或过时）
             total_rows = worksheet.max_row
-            logger.info(f"开始读取 {file_path} (类型: {query_type}), 共 {total_rows} 行")
+            # 只读模式的 iter_rows 以 <dimension> 声明的范围为界，导出文件中该声明可能过时（如 ref="A1"），
+            # 清除后按工作表中实际存在的行列读取，避免静默丢行
+            worksheet.reset_dimensions()
+            source_name = source if isinstance(source, str) else '内存数据'
+            logger.info(f"开始读取 {source_name} (类型: {query_type}), 共 {total_rows or '未知'} 行")
             
-            # 读取标题行，构建列索引映射
-            header_row = next(worksheet.iter_rows(min_row=1, max_row=1, values_only=True))
-            column_index_map = {}
+            # 读取标题行，编译行提取器
+            rows = worksheet.iter_rows(values_only=True)
+            header_row = next(rows, None)
+            if header_row is None:
+                logger.warning(f"{query_type} 工作表为空")
+                return
+            columns, extract = self._compile_extractor(header_row, query_type)
+            clean_value = self._clean_value
+            date_flags = [col_name in self.DATE_COLUMNS for col_name in columns]
             
-            # 创建标题到索引的映射
-            for idx, header in enumerate(header_row):
-                if header is None:
-                    continue
-                    
-                # 尝试匹配每个标准列名
-                for col_name, aliases in column_map.items():
-                    if header in aliases:
-                        column_index_map[col_name] = idx
-                        break
-            
-            # 检查是否所有必要列都存在
-            missing_columns = set(column_map.keys()) - set(column_index_map.keys())
-            if missing_columns:
-                logger.warning(f"缺少列: {', '.join(missing_columns)}，将使用默认映射")
-                # 回退到默认索引（如果可能）
-                for col_name in missing_columns:
-                    if col_name in self.COLUMN_MAPPING.get(query_type, {}):
-                        # 尝试使用第一个别名作为默认
-                        column_index_map[col_name] = self.COLUMN_MAPPING[query_type][col_name][0]
-            
-            # 跳过标题行，从第2行开始
+            # 标题行之后逐行处理
             processed_rows = 0
-            for row_idx, row in enumerate(worksheet.iter_rows(min_row=2, values_only=True), start=2):
-                # 跳过空行
-                if all(cell is None or cell == '' for cell in row):
-                    continue
-                    
-                item = {}
-                valid_row = False
+            for row in rows:
+                values = tuple([clean_value(value, flag) for value, flag in zip(extract(row), date_flags)])
                 
-                for col_name, col_idx in column_index_map.items():
-                    try:
-                        if col_idx < len(row):
-                            value = row[col_idx]
-                        else:
-                            value = None
-                            
-                        cleaned_value = self._clean_value(value)
-                        item[col_name] = cleaned_value
-                        
-                        # 如果至少有一个列有值，则认为是有效行
-                        if cleaned_value is not None and cleaned_value != '':
-                            valid_row = True
-                    except Exception as e:
-                        logger.warning(f"处理行 {row_idx} 列 {col_name} 时出错: {str(e)}")
-                        item[col_name] = None
-                
-                # 只添加有实际数据的行
-                if valid_row:
-                    data.append(item)
+                # 只产出有实际数据的行（跳过空行）
+                if any(value is not None and value != '' for value in values):
                     processed_rows += 1
+                    yield values
                     
                     # 每处理100行记录一次进度
                     if processed_rows % 100 == 0:
-                        logger.info(f"已处理 {processed_rows}/{total_rows - 1} 行")
+                        logger.info(f"已处理 {processed_rows}/{(total_rows or 1) - 1} 行")
             
             logger.info(f"成功读取 {processed_rows} 行数据")
-            return data
-        except Exception as e:
-            logger.error(f"读取 {query_type} Excel 文件时出错: {str(e)}")
-            logger.debug(traceback.format_exc())
-            return []
         finally:
-            # 尝试关闭工作簿
+            # 只读模式会保持文件句柄，必须关闭工作簿
+            workbook.close()
+
+def parse_export(source, query_type):
+    """解析导出内容（文件路径或 bytes），返回 (标准列名, 行元组列表, 解析耗时)
+
+    在解析进程中执行，参数和返回值都必须可以 pickle
+    """
+    started = time.perf_counter()
+    columns = list(ExcelProcessor.COLUMN_MAPPING.get(query_type, ()))
+    processor = ExcelProcessor()
+    if isinstance(source, (bytes, bytearray)):
+        records = processor.read_bytes(source, query_type)
+    else:
+        records = processor.read_file(source, query_type)
+    # 行字典按 COLUMN_MAPPING 的列顺序构造，转为值元组后跨进程传递更紧凑
+    rows = [tuple(record.values()) for record in records]
+    return columns, rows, time.perf_counter() - started
+
+# ====================== 值规范化 ======================
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+# 可能是日期的文本：4位年份开头，只含数字、日期分隔符、空格和冒号
+_DATE_SHAPE_PATTERN = re.compile(r'\d{4}[-/\d][\d\-/ :]*')
+
+def _date_shape(text):
+    """日期格式或文本的形态：(日期分隔符, 冒号数量)"""
+    separator = '-' if '-' in text else '/' if '/' in text else ''
+    return separator, text.count(':')
+
+# 每种形态最多只有一个 DATE_FORMATS 中的格式可能匹配
+_DATE_FORMAT_BY_SHAPE = {_date_shape(fmt): fmt for fmt in ExcelProcessor.DATE_FORMATS}
+
+@lru_cache(maxsize=VALUE_CACHE_SIZE)
+def normalize_text(value):
+    """移除不可见字符和多余空格"""
+    return _WHITESPACE_PATTERN.sub(' ', value).strip()
+
+@lru_cache(maxsize=VALUE_CACHE_SIZE)
+def normalize_date_text(value):
+    """规范化文本并按形态匹配的日期格式转换，无法识别时返回规范化后的文本"""
+    value = normalize_text(value)
+    if _DATE_SHAPE_PATTERN.fullmatch(value) is None:
+        return value
+        
+    fmt = _DATE_FORMAT_BY_SHAPE.get(_date_shape(value))
+    if fmt is None:
+        return value
+    try:
+        dt = datetime.strptime(value, fmt)
+    except ValueError:
+        return value
+    if ' ' in fmt:
+        return dt.isoformat(sep=' ')
+    return dt.date().isoformat()
+
+# ====================== 查询计划 ======================
+# 步骤完成条件
+WAIT_NONE = 'none'            # 点击即完成
+WAIT_VISIBLE = 'visible'      # 等待 Step.until 对应的元素可见且可用
+WAIT_UPLOAD = 'upload'        # 等待 .upload-success
+WAIT_DOWNLOAD = 'download'    # 由外层 expect_download 等待下载事件
+STEP_WAITS = (WAIT_NONE, WAIT_VISIBLE, WAIT_UPLOAD, WAIT_DOWNLOAD)
+
+@dataclass(frozen=True)
+class FormField:
+    """查询表单中由参数填写的输入框"""
+    selector: str
+    param: str
+    readonly: bool = False
+    required: bool = True
+
+@dataclass(frozen=True)
+class Step:
+    """点击序列中的一步及其完成条件；WAIT_VISIBLE 等待 until 选择器对应的元素可见且可用"""
+    selector: str
+    wait: str = WAIT_NONE
+    until: str = None
+
+@dataclass(frozen=True)
+class QueryPlan:
+    """一种门户查询的完整描述，由通用执行器执行"""
+    query_type: str
+    args: tuple
+    fields: tuple
+    steps: tuple
+    columns: MappingProxyType
+    upload_param: str = None
+    ready_selector: str = '#queryBtn'
+    fast_path: bool = False
+    # 表单需要的脚本（正则），其余脚本请求会被拦截
+    scripts: tuple = (f'^{re.escape(PORTAL_ORIGIN)}/',)
+
+    @property
+    def path(self):
+        return f'view/complex/{self.query_type}.html'
+
+    @property
+    def required_args(self):
+        """请求中必须提供的参数，可选表单字段对应的参数除外"""
+        optional = {field.param for field in self.fields if not field.required}
+        return tuple(arg for arg in self.args if arg not in optional)
+
+    def select(self, item):
+        """从请求体中取出本查询的参数，缺少的可选参数为 None"""
+        return {arg: item.get(arg) for arg in self.args}
+
+    def bind(self, args, kwargs):
+        """把 execute_query 的位置参数和关键字参数映射为参数字典"""
+        params = dict.fromkeys(self.args)
+        params.update(zip(self.args, args))
+        params.update(kwargs)
+        return params
+
+def _query_step():
+    """点击查询按钮，等到查询结果的确认按钮出现且可用，与门户的接口地址无关"""
+    return Step('#queryBtn', WAIT_VISIBLE, '#confirmBtn')
+
+def _plan(query_type, args, fields, steps, **options):
+    return QueryPlan(
+        query_type=query_type,
+        args=tuple(args),
+        fields=tuple(fields),
+        steps=tuple(steps),
+        columns=MappingProxyType(ExcelProcessor.COLUMN_MAPPING[query_type]),
+        **options
+    )
+
+QUERY_PLANS = MappingProxyType({plan.query_type: plan for plan in (
+    _plan(
+        'glcx',
+        args=('date_start', 'date_end', 'id_no'),
+        fields=(
+            FormField('input[name="startDate"]', 'date_start', readonly=True),
+            FormField('input[name="endDate"]', 'date_end', readonly=True),
+            FormField('#idNo', 'id_no'),
+        ),
+        steps=(
+            Step('#idNo'),
+            Step('#startDate'),
+            Step('#endDate'),
+            _query_step(),
+            Step('#confirmBtn'),
+            Step('#download', WAIT_DOWNLOAD),
+        ),
+        fast_path=True,
+    ),
+    _plan(
+        'zzcx',
+        args=('train_date', 'train_code', 'from_station', 'to_station'),
+        fields=(
+            FormField('input[name="trainDate"]', 'train_date', readonly=True),
+            FormField('#boardTrainCode', 'train_code'),
+            FormField('#fromStation', 'from_station'),
+            FormField('#toStation', 'to_station', required=False),
+        ),
+        steps=(
+            Step('#trainDate'),
+            Step('#boardTrainCode'),
+            Step('#fromStation'),
+            Step('#toStation'),
+            _query_step(),
+            Step('#confirmBtn'),
+            Step('#download', WAIT_DOWNLOAD),
+        ),
+        fast_path=True,
+    ),
+    _plan(
+        'plgjcx',
+        args=('date_start', 'date_end', 'id_no_list'),
+        fields=(
+            FormField('input[name="startDate"]', 'date_start', readonly=True),
+            FormField('input[name="endDate"]', 'date_end', readonly=True),
+        ),
+        steps=(
+            Step('#startDate'),
+            Step('#endDate'),
+            Step('#uploadBtn', WAIT_UPLOAD),
+            _query_step(),
+            Step('#confirmBtn'),
+            Step('#download', WAIT_DOWNLOAD),
+        ),
+        upload_param='id_no_list',
+    ),
+)})
+
+def validate_query_plans(plans):
+    """启动时校验查询计划，配置错误直接抛出 ValueError"""
+    for query_type, plan in plans.items():
+        problems = []
+        if query_type != plan.query_type:
+            problems.append(f"注册名与 query_type 不一致: {plan.query_type}")
+        if dict(plan.columns) != ExcelProcessor.COLUMN_MAPPING.get(query_type):
+            problems.append("列映射与 ExcelProcessor.COLUMN_MAPPING 不一致")
+        for field in plan.fields:
+            if field.param not in plan.args:
+                problems.append(f"表单字段 {field.selector} 使用了未声明的参数 {field.param}")
+        if plan.upload_param and plan.upload_param not in plan.args:
+            problems.append(f"上传参数 {plan.upload_param} 未声明")
+        for step in plan.steps:
+            if step.wait not in STEP_WAITS:
+                problems.append(f"步骤 {step.selector} 的等待条件无效: {step.wait}")
+            if step.wait == WAIT_VISIBLE and not step.until:
+                problems.append(f"步骤 {step.selector} 等待元素出现但未配置 until 选择器")
+        if not plan.steps or plan.steps[-1].wait != WAIT_DOWNLOAD:
+            problems.append("最后一步必须触发下载")
+        if any(step.wait == WAIT_DOWNLOAD for step in plan.steps[:-1]):
+            problems.append("只有最后一步可以触发下载")
+        if bool(plan.upload_param) != any(step.wait == WAIT_UPLOAD for step in plan.steps):
+            problems.append("上传参数与上传步骤必须同时配置")
+        for pattern in plan.scripts:
             try:
-                workbook.close()
-            except:
-                pass
+                re.compile(pattern)
+            except re.error as e:
+                problems.append(f"脚本白名单 {pattern!r} 不是有效的正则: {e}")
+        if problems:
+            raise ValueError(f"查询计划 {query_type} 无效: {'; '.join(problems)}")
+
+validate_query_plans(QUERY_PLANS)
+
+def parse_prewarm_pages(spec, plans):
+    """解析 PREWARM_PAGES（查询类型:页面数，逗号分隔），配置错误直接抛出 ValueError"""
+    counts = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        query_type, _, count = (part.strip() for part in item.partition(':'))
+        if query_type not in plans:
+            raise ValueError(f"PREWARM_PAGES 中的查询类型 {query_type!r} 未注册，可选: {', '.join(plans)}")
+        try:
+            counts[query_type] = int(count)
+        except ValueError:
+            raise ValueError(f"PREWARM_PAGES 中 {query_type} 的页面数 {count!r} 不是整数，格式为 查询类型:页面数") from None
+        if counts[query_type] < 0:
+            raise ValueError(f"PREWARM_PAGES 中 {query_type} 的页面数不能为负数: {count}")
+    return counts
+
+PREWARM_COUNTS = parse_prewarm_pages(PREWARM_PAGES, QUERY_PLANS)
+
+def concat_rows(row_lists):
+    """按顺序拼接互不重叠的子查询结果（日期子区间或证件号分片）
+
+    子查询之间没有重叠，不做去重：相同的行只可能是同一子查询中真实存在的多条记录
+    """
+    return [row for rows in row_lists for row in rows]
+
+def _month_index(day):
+    return day.year * 12 + day.month - 1
+
+def _month_start(index):
+    return date(index // 12, index % 12 + 1, 1)
+
+def _add_months(day, months):
+    """往后推 months 个月的同一天，目标月没有这一天时取月末"""
+    first = _month_start(_month_index(day) + months)
+    return first.replace(day=min(day.day, calendar.monthrange(first.year, first.month)[1]))
+
+def split_date_range(date_start, date_end, window_months):
+    """把闭区间 [date_start, date_end] 按自然月拆成子区间，每个子区间最多 window_months 个月，
+    且从公历年初起按 window_months 对齐（3 即按季度），使相同设置的查询落在相同的区间上，便于复用缓存
+
+    区间不长于 window_months 个月时不拆分，跨月的短区间原样查询；首尾只剩一天的子区间并入相邻子区间，
+    起止日期相同的查询无法生成快速通道的请求模板。保持原日期格式，无需或无法拆分时返回原区间
+    """
+    whole = [(date_start, date_end)]
+    if window_months <= 0 or not isinstance(date_start, str) or not isinstance(date_end, str):
+        return whole
+        
+    fmt = _DATE_FORMAT_BY_SHAPE.get(_date_shape(date_start.strip()))
+    # 只拆分纯日期，带时间的范围原样查询
+    if fmt is None or ' ' in fmt:
+        return whole
+    try:
+        start = datetime.strptime(date_start.strip(), fmt).date()
+        end = datetime.strptime(date_end.strip(), fmt).date()
+    except ValueError:
+        return whole
+    if start > end or end < _add_months(start, window_months):
+        return whole
+        
+    windows = []
+    window_start = start
+    while window_start <= end:
+        index = _month_index(window_start)
+        next_start = _month_start(index - index % window_months + window_months)
+        window_end = min(end, next_start - timedelta(days=1))
+        windows.append([window_start, window_end])
+        window_start = window_end + timedelta(days=1)
+    if len(windows) > 1 and windows[0][0] == windows[0][1]:
+        head = windows.pop(0)
+        windows[0][0] = head[0]
+    if len(windows) > 1 and windows[-1][0] == windows[-1][1]:
+        tail = windows.pop()
+        windows[-1][1] = tail[1]
+    if len(windows) < 2:
+        return whole
+    return [(window_start.strftime(fmt), window_end.strftime(fmt)) for window_start, window_end in windows]
+
+def split_into_shards(items, shard_size):
+    """按分片大小切分列表，空列表返回一个空分片"""
+    if shard_size <= 0 or not items:
+        return [list(items)]
+    return [list(items[i:i + shard_size]) for i in range(0, len(items), shard_size)]
 
 # ====================== Playwright 自动化工具 ======================
+class SessionExpiredError(Exception):
+    """登录会话已失效（页面被重定向回登录页）"""
+
+class QueryError(Exception):
+    """查询执行失败（区别于查询成功但没有数据）"""
+
+class PooledPage:
+    """池中已登录并停留在查询页的页面"""
+
+    def __init__(self, context, page, query_type, session_version):
+        self.context = context
+        self.page = page
+        self.query_type = query_type
+        self.session_version = session_version
+        self.created_at = time.time()
+        # 从空闲池借出、尚未重新加载的页面，点击查询前需要重新加载
+        self.needs_reload = False
+
+class ContextPool:
+    """预热的已登录查询页面池，限制同时打开的浏览器上下文数量"""
+
+    def __init__(self, automator, size):
+        self.automator = automator
+        self.size = size
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle = {}
+        self._open = 0
+
+    def idle_count(self, query_type=None):
+        """空闲页面数量"""
+        if query_type is not None:
+            return len(self._idle.get(query_type, []))
+        return sum(len(entries) for entries in self._idle.values())
+
+    def open_count(self):
+        """已打开的页面数量（使用中 + 空闲）"""
+        return self._open
+
+    async def _create(self, query_type):
+        """创建新的上下文，并导航到查询页"""
+        automator = self.automator
+        session_version = await automator.ensure_session()
+        context, page = await automator._new_page(automator.storage_state, query_type)
+        try:
+            await self._navigate(page, query_type)
+        except Exception:
+            await context.close()
+            raise
+        self._open += 1
+        logger.info(f"查询页面池新建 {query_type} 页面 ({self._open}/{self.size})")
+        return PooledPage(context, page, query_type, session_version)
+
+    async def _navigate(self, page, query_type):
+        """导航到查询页并等待表单可用；被重定向到登录页或返回 401 时抛出 SessionExpiredError"""
+        plan = QUERY_PLANS[query_type]
+        with metrics.span('navigation', query_type):
+            response = await page.goto(f'{PORTAL_BASE_URL}/{plan.path}', wait_until='domcontentloaded')
+            if self.automator._is_login_page(page) or (response is not None and response.status == 401):
+                raise SessionExpiredError(f"访问 {query_type} 查询页时返回 401 或被重定向到登录页")
+            # 就绪元素出现即表示表单可用，不必等待全部资源加载完
+            await page.wait_for_selector(plan.ready_selector, timeout=self.automator.timeout)
+
+    async def _discard(self, entry):
+        """关闭并移出池中的页面"""
+        self._open -= 1
+        try:
+            await entry.context.close()
+        except Exception as e:
+            logger.warning(f"关闭池中页面失败: {e}")
+
+    def _reusable(self, entry, now=None):
+        """页面未关闭、属于当前会话且未超过最长存活时间"""
+        if PAGE_MAX_AGE and (now or time.time()) - entry.created_at > PAGE_MAX_AGE:
+            return False
+        return entry.session_version == self.automator.session_version and not entry.page.is_closed()
+
+    async def recycle(self):
+        """关闭已失效或超过最长存活时间的空闲页面，返回关闭的数量"""
+        now = time.time()
+        recycled = 0
+        for entries in self._idle.values():
+            for entry in [entry for entry in entries if not self._reusable(entry, now)]:
+                if entry in entries:
+                    entries.remove(entry)
+                    await self._discard(entry)
+                    recycled += 1
+        if recycled:
+            logger.info(f"查询页面池回收 {recycled} 个过旧或失效的页面")
+        return recycled
+
+    async def prewarm(self, counts):
+        """按查询类型预先打开空闲页面，补足到 counts 指定的数量，不超过池容量"""
+        async def open_page(query_type):
+            async with self._semaphore:
+                if self._open >= self.size:
+                    return 0
+                entry = await self._create(query_type)
+                self._idle.setdefault(query_type, []).append(entry)
+                return 1
+        
+        tasks = [
+            open_page(query_type)
+            for query_type, count in counts.items()
+            for _ in range(count - self.idle_count(query_type))
+        ]
+        return sum(await asyncio.gather(*tasks))
+
+    def default_prewarm_counts(self):
+        """按查询类型轮流分配池容量"""
+        counts = dict.fromkeys(QUERY_PLANS, 0)
+        query_types = list(QUERY_PLANS)
+        for idx in range(self.size):
+            counts[query_types[idx % len(query_types)]] += 1
+        return counts
+
+    async def ping(self):
+        """用一个空闲页面的上下文请求其查询页，保持门户会话活跃
+
+        返回 False 表示被重定向到登录页（会话已失效），没有空闲页面时返回 None
+        """
+        for entries in self._idle.values():
+            if not entries:
+                continue
+            entry = entries[-1]
+            response = await entry.context.request.get(
+                f'{PORTAL_BASE_URL}/{QUERY_PLANS[entry.query_type].path}',
+                timeout=self.automator.timeout,
+                ignore_https_errors=True
+            )
+            try:
+                return not self.automator._is_login_url(response.url)
+            finally:
+                await response.dispose()
+        return None
+
+    async def _take_idle(self, query_type):
+        """取出一个可复用的空闲页面，丢弃旧会话或已关闭的页面"""
+        entries = self._idle.get(query_type)
+        while entries:
+            entry = entries.pop()
+            if self._reusable(entry):
+                return entry
+            await self._discard(entry)
+        return None
+
+    async def _evict_idle(self):
+        """关闭最早放回的一个空闲页面，为其他查询类型腾出位置"""
+        for entries in self._idle.values():
+            if entries:
+                await self._discard(entries.pop(0))
+                return
+
+    async def _reset(self, entry):
+        """复用前重新加载查询页
+
+        只重置表单会留下上一次查询的上传成功提示、确认框和下载链接，
+        上传步骤会被旧的 .upload-success 立即满足；重新加载同时能发现空闲期间已过期的会话
+        """
+        await self._navigate(entry.page, entry.query_type)
+
+    async def reload_if_needed(self, entry):
+        """借出时推迟了重新加载的页面，在点击查询前重新加载"""
+        if entry.needs_reload:
+            await self._reset(entry)
+            entry.needs_reload = False
+
+    @asynccontextmanager
+    async def checkout(self, query_type, reload=True):
+        """借出一个查询页面，使用完毕后放回池中
+
+        reload=False 时复用的页面暂不重新加载（快速通道不使用页面），由调用方按需调用 reload_if_needed
+        """
+        waited_from = time.perf_counter()
+        async with self._semaphore:
+            metrics.observe('cyber_pool_wait_seconds', time.perf_counter() - waited_from, query_type=query_type)
+            entry = await self._take_idle(query_type)
+            if entry is not None:
+                entry.needs_reload = True
+            if entry is not None and reload:
+                try:
+                    await self.reload_if_needed(entry)
+                except SessionExpiredError:
+                    await self._discard(entry)
+                    raise
+                except Exception as e:
+                    logger.warning(f"重置 {query_type} 页面失败，重新创建: {e}")
+                    await self._discard(entry)
+                    entry = None
+            if entry is None:
+                if self._open >= self.size:
+                    await self._evict_idle()
+                entry = await self._create(query_type)
+            
+            healthy = False
+            try:
+                yield entry
+                healthy = True
+            finally:
+                if healthy and self._reusable(entry):
+                    self._idle.setdefault(query_type, []).append(entry)
+                else:
+                    await self._discard(entry)
+
+    async def close(self):
+        """关闭所有空闲页面"""
+        for entries in self._idle.values():
+            while entries:
+                await self._discard(entries.pop())
+
+# ====================== 导出请求录制与重放 ======================
+class RequestTemplate:
+    """从一次页面查询中录制的请求序列，参数值被替换为占位符"""
+    PLACEHOLDER_PATTERN = re.compile(r'\{\{(\w+):(\w+)\}\}')
+    ENCODERS = {
+        'raw': lambda value: value,
+        'quote': lambda value: quote(value, safe=''),
+        'plus': lambda value: quote_plus(value),
+    }
+    DROPPED_HEADERS = {'cookie', 'content-length', 'host'}
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    @classmethod
+    def build(cls, requests, params):
+        """用参数值生成模板，参数值无法唯一定位时返回 None"""
+        values = {name: str(value) for name, value in params.items() if value}
+        if len(set(values.values())) != len(values):
+            return None
+        
+        steps = []
+        found = set()
+        for req in requests:
+            step = {
+                'method': req['method'],
+                'url': req['url'],
+                'headers': {
+                    key: value for key, value in req['headers'].items()
+                    if key.lower() not in cls.DROPPED_HEADERS
+                },
+                'data': req['data'],
+            }
+            content_type = next(
+                (value for key, value in step['headers'].items() if key.lower() == 'content-type'), ''
+            )
+            # 值在各编码下相同时按字段位置选择编码，保证新值含特殊字符时仍能正确编码
+            encodings = {
+                'url': ('quote', 'plus', 'raw'),
+                'data': ('raw',) if 'json' in content_type else ('plus', 'quote', 'raw'),
+            }
+            # 先替换较长的值，避免短值命中长值的片段
+            for name, value in sorted(values.items(), key=lambda kv: -len(kv[1])):
+                for field, enc_names in encodings.items():
+                    for enc_name in enc_names:
+                        encoded = cls.ENCODERS[enc_name](value)
+                        if step[field] and encoded in step[field]:
+                            step[field] = step[field].replace(encoded, f'{{{{{name}:{enc_name}}}}}')
+                            found.add(name)
+            steps.append(step)
+        
+        if found != set(values):
+            return None
+        return cls(steps)
+
+    def render(self, params):
+        """用新的参数值生成请求序列"""
+        def substitute(text):
+            if not text:
+                return text
+            return self.PLACEHOLDER_PATTERN.sub(
+                lambda m: self.ENCODERS[m.group(2)](str(params.get(m.group(1)) or '')),
+                text
+            )
+        
+        return [
+            {
+                'method': step['method'],
+                'url': substitute(step['url']),
+                'headers': step['headers'],
+                'data': substitute(step['data']),
+            }
+            for step in self.steps
+        ]
+
+    @staticmethod
+    def key(query_type, params):
+        """模板按查询类型和实际填写的字段区分"""
+        return (query_type, tuple(sorted(name for name, value in params.items() if value)))
+
+class RequestRecorder:
+    """录制查询页面点击 #queryBtn 和 #download 时发出的请求"""
+    RECORDED_TYPES = ('xhr', 'fetch', 'document')
+
+    def __init__(self, page):
+        self.page = page
+        self.requests = []
+        self._binary = False
+
+    def _on_request(self, req):
+        if req.resource_type not in self.RECORDED_TYPES:
+            return
+        if req.method != 'POST' and '?' not in req.url:
+            return
+        try:
+            data = req.post_data
+        except Exception:
+            # 二进制请求体（如文件上传）无法模板化
+            self._binary = True
+            return
+        self.requests.append({
+            'method': req.method,
+            'url': req.url,
+            'headers': dict(req.headers),
+            'data': data,
+        })
+
+    async def __aenter__(self):
+        self.page.on("request", self._on_request)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.page.remove_listener("request", self._on_request)
+
+    def build_template(self, download_url, params):
+        """截取到导出请求为止的请求序列生成模板"""
+        if self._binary or not download_url or download_url.startswith('blob:'):
+            return None
+        for idx, req in enumerate(self.requests):
+            if req['url'] == download_url:
+                return RequestTemplate.build(self.requests[:idx + 1], params)
+        return None
+
+# ====================== 查询结果缓存 ======================
+class ResultCache:
+    """按查询类型设置有效期、按条数和字节数做 LRU 淘汰的结果缓存"""
+
+    def __init__(self, ttls, max_entries, max_bytes):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(value):
+        """参数值规范化：去除空白、统一大小写和日期格式，列表忽略顺序"""
+        if isinstance(value, (list, tuple)):
+            return tuple(sorted(ResultCache._normalize(item) for item in value))
+        if value is None:
+            return ''
+        return normalize_date_text(str(value)).upper()
+
+    @staticmethod
+    def make_key(query_type, params):
+        """由查询类型和规范化后的参数生成缓存键"""
+        return (query_type,) + tuple(
+            (name, ResultCache._normalize(value)) for name, value in sorted(params.items())
+        )
+
+    def get(self, key):
+        """返回未过期的缓存结果，不存在时返回 None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, size, rows = entry
+        if time.monotonic() >= expires_at:
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return rows
+
+    def put(self, key, query_type, rows):
+        """缓存查询结果；空结果不缓存，避免把失败或暂未出票的情况固定下来"""
+        ttl = self.ttls.get(query_type, 0)
+        if ttl <= 0 or not rows:
+            return
+        size = len(dumps_json(rows))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, size, rows)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        """缓存命中统计"""
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+# ====================== 导出解析池 ======================
+class ParsePool:
+    """在进程池或线程池中解析导出文件，避免大文件解析阻塞浏览器事件循环"""
+    MODES = ('process', 'thread', 'inline')
+
+    def __init__(self, mode, workers):
+        if mode not in self.MODES:
+            raise ValueError(f"未知的解析方式: {mode}")
+        self.mode = mode
+        self.workers = workers
+        self.pending = 0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.mode == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='parse')
+        return self._executor
+
+    async def parse(self, source, query_type):
+        """解析导出内容，返回 parse_export 的结果"""
+        self.pending += 1
+        try:
+            if self.mode == 'inline':
+                return parse_export(source, query_type)
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self._get_executor(), parse_export, source, query_type)
+            except BrokenProcessPool:
+                # 解析进程异常退出后进程池不可再用，下次解析时重建
+                logger.error("解析进程池已损坏，将重新创建")
+                self._executor = None
+                raise
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+# ====================== 资源拦截 ======================
+class ResourceFilter:
+    """浏览器上下文的资源拦截路由，按页面用途（login 或查询类型）统计放行和拦截的请求数"""
+
+    def __init__(self, blocked_types, blocked_url_pattern, script_allowlists):
+        self.blocked_types = blocked_types
+        self.blocked_url_pattern = blocked_url_pattern
+        self.script_allowlists = {
+            scope: tuple(re.compile(pattern) for pattern in patterns)
+            for scope, patterns in script_allowlists.items()
+        }
+        self._counts = {}
+
+    def _block_reason(self, request, scope):
+        """返回拦截原因，放行时返回 None"""
+        resource_type = request.resource_type
+        if resource_type in self.blocked_types:
+            return resource_type
+        if self.blocked_url_pattern.search(request.url):
+            return 'url'
+        if resource_type == 'script':
+            allowlist = self.script_allowlists.get(scope)
+            if allowlist is not None and not any(pattern.search(request.url) for pattern in allowlist):
+                return 'script'
+        return None
+
+    async def install(self, context, scope):
+        """在上下文上注册拦截路由，必须在页面导航之前调用"""
+        async def handle(route):
+            await self._handle(route, scope)
+        await context.route('**/*', handle)
+
+    async def _handle(self, route, scope):
+        reason = self._block_reason(route.request, scope)
+        counts = self._counts.get(scope)
+        if counts is None:
+            counts = self._counts[scope] = {'allowed': 0, 'blocked': 0, 'blocked_by_reason': {}}
+        try:
+            if reason is None:
+                counts['allowed'] += 1
+                await route.continue_()
+            else:
+                counts['blocked'] += 1
+                by_reason = counts['blocked_by_reason']
+                by_reason[reason] = by_reason.get(reason, 0) + 1
+                await route.abort('blockedbyclient')
+        except Exception as e:
+            # 页面或上下文已关闭时路由无法再处理，忽略即可
+            logger.debug(f"处理请求路由失败 ({scope}): {e}")
+
+    def stats(self):
+        """放行与拦截统计"""
+        return {
+            'allowed': sum(counts['allowed'] for counts in self._counts.values()),
+            'blocked': sum(counts['blocked'] for counts in self._counts.values()),
+            'scopes': {
+                scope: dict(counts, blocked_by_reason=dict(counts['blocked_by_reason']))
+                for scope, counts in self._counts.items()
+            },
+        }
+
+# ====================== 并发查询合并 ======================
+class SingleFlight:
+    """相同键的并发查询只执行一次，其余调用者等待同一结果"""
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    def in_flight(self):
+        return len(self._calls)
+
+    async def do(self, key, factory):
+        """执行 factory() 或加入同键的进行中调用；异常会传给所有等待者"""
+        call = self._calls.get(key)
+        if call is None:
+            call = {'task': asyncio.ensure_future(factory()), 'waiters': 0}
+            self._calls[key] = call
+            call['task'].add_done_callback(lambda task: self._forget(key, call))
+        else:
+            self.coalesced += 1
+            
+        call['waiters'] += 1
+        try:
+            # shield 保证单个等待者被取消时不会取消共享的执行
+            return await asyncio.shield(call['task'])
+        finally:
+            call['waiters'] -= 1
+            # 所有等待者都已取消时，没有人需要结果，取消共享执行
+            if call['waiters'] == 0 and not call['task'].done():
+                self._forget(key, call)
+                call['task'].cancel()
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
 class PlaywrightAutomator:
     def __init__(self):
         self.playwright = None
         self.browser = None
         self.timeout = 60000
-        self.data_dir = tempfile.mkdtemp(prefix="pw_data_")
         self._initialized = False
         self.lock = asyncio.Lock()
+        # 登录会话缓存
+        self.storage_state = None
+        self.session_version = 0
+        self.session_started_at = 0
+        self.session_expires_at = 0
+        self._observed_lifetime = None
+        self._session_lock = asyncio.Lock()
+        self.pool = ContextPool(self, CONTEXT_POOL_SIZE)
+        # 启动预热与保活状态，供 /cyber/health 读取
+        self.prewarm_requested = False
+        self.prewarm_state = {'status': 'idle', 'started_at': None, 'finished_at': None, 'pages': 0, 'error': None}
+        self.keepalive_state = {'last_run': None, 'last_ok': None, 'recycled': 0, 'error': None}
+        # 快速通道的请求模板
+        self._request_templates = {}
+        self.cache = ResultCache(RESULT_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_BYTES)
+        self.inflight = SingleFlight()
+        self.parser = ParsePool(PARSE_EXECUTOR, PARSE_WORKERS)
+        self.resources = ResourceFilter(
+            BLOCKED_RESOURCE_TYPES,
+            BLOCKED_URL_PATTERN,
+            dict({'login': LOGIN_SCRIPTS}, **{qt: plan.scripts for qt, plan in QUERY_PLANS.items()})
+        )
 
     async def initialize(self):
         """异步初始化Playwright环境"""
@@ -243,17 +1336,21 @@ class PlaywrightAutomator:
                 
             try:
                 logger.info("正在初始化Playwright环境...")
-                self.playwright = await async_playwright().start()
-                self.browser = await self.playwright.chromium.launch(
-                    headless=False,
-                    args=[
-                        '--start-maximized',
-                        '--disable-web-security',
-                        '--ignore-certificate-errors',
-                        '--allow-insecure-localhost'
-                    ],
-                    slow_mo=1000
-                )
+                if self.playwright is None:
+                    self.playwright = await async_playwright().start()
+                with metrics.span('launch'):
+                    self.browser = await self.playwright.chromium.launch(
+                        headless=BROWSER_HEADLESS,
+                        args=[
+                            '--start-maximized',
+                            '--disable-web-security',
+                            '--ignore-certificate-errors',
+                            '--allow-insecure-localhost'
+                        ],
+                        slow_mo=PACING['slow_mo']
+                    )
+                # 浏览器常驻进程内，意外断开后允许下次请求重新初始化
+                self.browser.on("disconnected", lambda browser: self._on_browser_disconnected())
                 self._initialized = True
                 logger.info("Playwright环境初始化成功")
             except Exception as e:
@@ -264,73 +1361,86 @@ class PlaywrightAutomator:
     
     def is_initialized(self):
         return self._initialized
+
+    def _on_browser_disconnected(self):
+        """浏览器进程退出或崩溃时重置初始化状态"""
+        if self._initialized:
+            logger.warning("浏览器连接已断开，下次查询时将重新初始化")
+        self._initialized = False
     
     async def close(self):
         """关闭所有资源"""
         async with self.lock:
             try:
+                self._initialized = False
+                self.storage_state = None
+                self.session_expires_at = 0
+                await self.pool.close()
+                self.parser.shutdown()
                 if self.browser:
                     await self.browser.close()
+                    self.browser = None
                 if self.playwright:
                     await self.playwright.stop()
-                self._initialized = False
+                    self.playwright = None
                 logger.info("Playwright资源已关闭")
             except Exception as e:
                 logger.error(f"关闭资源时出错: {e}")
                 return False
             return True
 
+    async def _wait_for_window(self, title, present, timeout):
+        """轮询等待指定标题的窗口出现或消失，返回窗口列表"""
+        deadline = time.monotonic() + timeout
+        while True:
+            windows = gw.getWindowsWithTitle(title)
+            if bool(windows) == present or time.monotonic() >= deadline:
+                return windows
+            await asyncio.sleep(0.1)
+
     async def _handle_certificate_popup(self):
         """处理Windows数字证书弹窗"""
         try:
-            await asyncio.sleep(2)
-            cert_windows = gw.getWindowsWithTitle("数字证书")
+            cert_windows = await self._wait_for_window("数字证书", True, CERT_POPUP_TIMEOUT)
             if cert_windows:
                 window = cert_windows[0]
                 window.activate()
                 pyautogui.write("公共密码")  # 替换为实际密码
                 pyautogui.press("enter")
-                await asyncio.sleep(1)
+                # 等待弹窗关闭
+                await self._wait_for_window("数字证书", False, CERT_POPUP_TIMEOUT)
                 return True
             return False
         except Exception as e:
             logger.error(f"处理证书弹窗失败: {e}")
             return False
 
+    async def _new_page(self, storage_state=None, scope='login'):
+        """创建独立的浏览器上下文和页面；scope 为 login 或查询类型，决定脚本白名单"""
+        context = await self.browser.new_context(
+            ignore_https_errors=True,
+            accept_downloads=True,
+            viewport={'width': 1920, 'height': 1080},
+            storage_state=storage_state
+        )
+        if RESOURCE_BLOCKING_ENABLED:
+            await self.resources.install(context, scope)
+        page = await context.new_page()
+        page.on("dialog", lambda dialog: dialog.accept())
+        page.on("certificateerror", lambda error: error.continue_())
+        return context, page
+
     async def test_login(self):
         """测试登录流程并返回网站标题"""
         if not self._initialized:
             await self.initialize()
             
+        context = page = None
         try:
             # 为测试创建独立的上下文和页面
-            context = await self.browser.new_context(
-                ignore_https_errors=True,
-                accept_downloads=True,
-                viewport={'width': 1920, 'height': 1080}
-            )
-            page = await context.new_page()
-            page.on("dialog", lambda dialog: dialog.accept())
-            page.on("certificateerror", lambda error: error.continue_())
-            
-            # 导航到登录页
-            await page.goto('https://10.3.2.201:9943/rntibp/login.html', timeout=self.timeout)
-            
-            # 处理证书错误页面
-            if await page.is_visible('text="此网站的安全证书存在问题"', timeout=5000):
-                await page.click('text=高级')
-                await page.click('text=继续前往(不安全)')
-                await self._handle_certificate_popup()
-            
-            # 登录处理
-            if await page.is_visible('#loginBtn', timeout=5000):
-                await page.fill('input[type="password"]', '111111')
-                await page.click('#loginBtn')
-                await page.wait_for_load_state('networkidle')
-            
-            # 验证登录成功
-            await page.wait_for_selector('.dashboard', timeout=self.timeout)
-            logger.info("登录成功")
+            context, page = await self._new_page()
+            if not await self._ensure_login(page):
+                raise RuntimeError("未进入系统首页")
             
             # 获取网站标题
             title = await page.title()
@@ -347,10 +1457,10 @@ class PlaywrightAutomator:
                 await context.close()
 
     async def _ensure_login(self, page):
-        """确保用户已登录"""
+        """在页面中完成登录流程"""
         try:
             # 导航到登录页
-            await page.goto('https://10.3.2.201:9943/rntibp/login.html', timeout=self.timeout)
+            await page.goto(f'{PORTAL_BASE_URL}/login.html', timeout=self.timeout)
             
             # 处理证书错误页面
             if await page.is_visible('text="此网站的安全证书存在问题"', timeout=5000):
@@ -362,9 +1472,8 @@ class PlaywrightAutomator:
             if await page.is_visible('#loginBtn', timeout=5000):
                 await page.fill('input[type="password"]', '111111')
                 await page.click('#loginBtn')
-                await page.wait_for_load_state('networkidle')
             
-            # 验证登录成功
+            # 验证登录成功（首页 .dashboard 出现）
             await page.wait_for_selector('.dashboard', timeout=self.timeout)
             logger.info("登录成功")
             return True
@@ -372,256 +1481,467 @@ class PlaywrightAutomator:
             logger.error(f"登录失败: {e}")
             return False
 
-    async def _prepare_form(self, page, query_type, params):
-        """安全操作表单元素"""
+    # ====================== 登录会话缓存 ======================
+    def _session_valid(self):
+        """会话存在且未进入提前刷新窗口"""
+        return (
+            self.storage_state is not None
+            and time.time() < self.session_expires_at - SESSION_REFRESH_MARGIN
+        )
+
+    def _compute_session_expiry(self, state, started_at):
+        """根据cookie过期时间和已观察到的会话寿命估算过期时刻"""
+        lifetime = SESSION_TTL
+        if self._observed_lifetime:
+            lifetime = min(lifetime, self._observed_lifetime)
+        expires_at = started_at + lifetime
+        
+        # 只看门户域名下的会话cookie；会话cookie的 expires 为 -1，只取有明确过期时间的cookie。
+        # 刷新窗口内就会过期的cookie（埋点、CSRF 等短期cookie）不可能是登录会话，忽略，否则每次查询都会重新登录
+        host = _portal.hostname or ''
+        names = SESSION_COOKIE_NAMES if any(
+            cookie.get('name') in SESSION_COOKIE_NAMES for cookie in state.get('cookies', [])
+        ) else None
+        cookie_expiry = [
+            cookie['expires'] for cookie in state.get('cookies', [])
+            if cookie.get('expires', -1) > started_at + SESSION_REFRESH_MARGIN
+            and host.endswith(cookie.get('domain', '').lstrip('.'))
+            and (names is None or cookie.get('name') in names)
+        ]
+        if cookie_expiry:
+            expires_at = min(expires_at, min(cookie_expiry))
+        return expires_at
+
+    async def _login(self):
+        """登录一次并缓存上下文的 storage_state（cookies 和 localStorage）"""
+        context = page = None
+        try:
+            context, page = await self._new_page()
+            with metrics.span('login') as span:
+                logged_in = await self._ensure_login(page)
+                if not logged_in:
+                    span.outcome = 'error'
+            if not logged_in:
+                return False
+            
+            started_at = time.time()
+            state = await context.storage_state()
+            self.storage_state = state
+            self.session_started_at = started_at
+            self.session_expires_at = self._compute_session_expiry(state, started_at)
+            self.session_version += 1
+            logger.info(
+                f"登录会话已缓存 (版本 {self.session_version}), "
+                f"预计 {int(self.session_expires_at - started_at)} 秒后刷新"
+            )
+            return True
+        finally:
+            if page:
+                await page.close()
+            if context:
+                await context.close()
+
+    async def ensure_session(self):
+        """返回可用的会话版本，必要时重新登录"""
+        if self._session_valid():
+            return self.session_version
+            
+        async with self._session_lock:
+            # 等待锁期间可能已有其他协程完成登录
+            if self._session_valid():
+                return self.session_version
+            if not await self._login():
+                raise RuntimeError("登录失败，无法建立会话")
+            return self.session_version
+
+    def invalidate_session(self, version):
+        """标记会话失效，并记录实际观察到的会话寿命"""
+        if version != self.session_version or self.storage_state is None:
+            return
+        lifetime = time.time() - self.session_started_at
+        if lifetime > SESSION_REFRESH_MARGIN:
+            self._observed_lifetime = lifetime
+        logger.warning(f"登录会话已失效 (版本 {version}), 存活 {int(lifetime)} 秒")
+        self.session_expires_at = 0
+
+    @staticmethod
+    def _is_login_url(url):
+        """地址是否为登录页"""
+        return 'login.html' in url
+
+    @staticmethod
+    def _is_login_page(page):
+        """页面是否被重定向回登录页"""
+        return PlaywrightAutomator._is_login_url(page.url)
+
+    async def _prepare_form(self, page, plan, params):
+        """按查询计划填写表单"""
         try:
             # 设置背景色
             await page.locator('.main-padding').evaluate(
                 "node => node.style.backgroundColor = '#f0f0f0'"
             )
             
-            if query_type == 'glcx':
-                # 移除只读属性
-                await page.locator('input[name="startDate"]').evaluate(
-                    "node => node.removeAttribute('readonly')"
-                )
-                await page.locator('input[name="endDate"]').evaluate(
-                    "node => node.removeAttribute('readonly')"
-                )
-                
-                # 设置值
-                await page.fill('input[name="startDate"]', params['date_start'])
-                await page.fill('input[name="endDate"]', params['date_end'])
-                await page.fill('#idNo', params['id_no'])
-                
-            elif query_type == 'zzcx':
-                await page.locator('input[name="trainDate"]').evaluate(
-                    "node => node.removeAttribute('readonly')"
-                )
-                await page.fill('input[name="trainDate"]', params['train_date'])
-                await page.fill('#boardTrainCode', params['train_code'])
-                await page.fill('#fromStation', params['from_station'])
-                
-                # 可选字段处理
-                if params.get('to_station'):
-                    await page.fill('#toStation', params['to_station'])
-            
-            elif query_type == 'plgjcx':
-                await page.locator('input[name="startDate"]').evaluate(
-                    "node => node.removeAttribute('readonly')"
-                )
-                await page.locator('input[name="endDate"]').evaluate(
-                    "node => node.removeAttribute('readonly')"
-                )
-                await page.fill('input[name="startDate"]', params['date_start'])
-                await page.fill('input[name="endDate"]', params['date_end'])
+            for field in plan.fields:
+                value = params.get(field.param)
+                # 可选字段为空时跳过
+                if not field.required and not value:
+                    continue
+                if field.readonly:
+                    # 移除只读属性
+                    await page.locator(field.selector).evaluate(
+                        "node => node.removeAttribute('readonly')"
+                    )
+                await page.fill(field.selector, value)
                 
             return True
         except Exception as e:
             logger.error(f"表单准备失败: {e}")
             return False
 
-    async def _download_excel(self, page, filename_prefix):
+    async def _parse_export(self, source, query_type):
+        """在解析池中解析导出内容，完成后把行数计入当前异步任务的进度"""
+        with metrics.span('parse', query_type):
+            columns, rows, seconds = await self.parser.parse(source, query_type)
+        metrics.observe('cyber_parse_seconds', seconds, query_type=query_type)
+        job = current_job.get()
+        if job and rows:
+            job.add_rows(len(rows))
+        return [dict(zip(columns, row)) for row in rows]
+
+    @staticmethod
+    async def _wait_download(download_info, query_type):
+        """等待门户生成导出文件并下载完成，整个等待计入 download 阶段（超时计入 cyber_timeouts_total）"""
+        with metrics.span('download', query_type):
+            download = await download_info.value
+            await download.path()
+        return download
+
+    async def _parse_download(self, download, query_type):
+        """直接解析已下载完成的文件，并删除下载产物"""
+        try:
+            return await self._parse_export(await download.path(), query_type)
+        finally:
+            # 池中的上下文长期存活，下载产物需要主动删除
+            try:
+                await download.delete()
+            except Exception as e:
+                logger.warning(f"删除下载文件失败: {e}")
+
+    async def _download_excel(self, page, query_type):
         """安全处理文件下载"""
-        save_path = None
         try:
-            # 创建唯一文件名
-            file_name = f"{filename_prefix}_{uuid.uuid4().hex}.xlsx"
-            save_path = os.path.join(self.data_dir, file_name)
-            
             # 等待下载开始
             async with page.expect_download(timeout=self.timeout) as download_info:
                 await page.click('#download')
-                await asyncio.sleep(1)  # 确保点击生效
+                download = await self._wait_download(download_info, query_type)
             
-            download = await download_info.value
-            
-            # 保存文件
-            await download.save_as(save_path)
-            
-            # 处理Excel
-            processor = ExcelProcessor()
-            result = processor.read_file(save_path, filename_prefix.split('_')[0])
-            return result
+            return await self._parse_download(download, query_type)
         except Exception as e:
             logger.error(f"下载失败: {e}")
             return []
-        finally:
-            # 确保清理文件
-            if save_path and os.path.exists(save_path):
-                try:
-                    os.unlink(save_path)
-                except:
-                    pass
+
+    async def _run_step(self, page, step):
+        """点击一个步骤元素，并等待该步骤的完成条件"""
+        selector = step.selector
+        delay = random.uniform(*PACING['click_delay'])
+        if delay:
+            # 人工节奏：点击前随机停顿
+            await asyncio.sleep(delay)
+            
+        async def click():
+            try:
+                # 更稳健的点击实现：等待元素可见且可用后点击中心位置
+                element = await page.wait_for_selector(selector, timeout=5000)
+                await element.wait_for_element_state('enabled', timeout=5000)
+                await element.scroll_into_view_if_needed()
+                box = await element.bounding_box()
+                await page.mouse.click(
+                    box['x'] + box['width']/2,
+                    box['y'] + box['height']/2
+                )
+            except Exception as e:
+                logger.warning(f"点击元素 {selector} 失败: {e}")
+                # 尝试备用点击方法
+                await page.click(selector, timeout=2000, force=True)
+        
+        if step.wait == WAIT_VISIBLE:
+            # 等待查询结果出现，而不是固定等待；只看页面状态，不依赖门户的接口地址
+            await click()
+            try:
+                element = await page.wait_for_selector(step.until, state='visible', timeout=QUERY_RESPONSE_TIMEOUT)
+                await element.wait_for_element_state('enabled', timeout=QUERY_RESPONSE_TIMEOUT)
+            except PlaywrightTimeoutError:
+                logger.warning(f"点击 {selector} 后 {step.until} 未出现，继续执行")
+        elif step.wait == WAIT_UPLOAD:
+            await click()
+            await page.wait_for_selector('.upload-success', timeout=30000)
+        else:
+            # WAIT_DOWNLOAD 由外层 expect_download 等待下载事件
+            await click()
+            
+        if PACING['settle_ms'] and step.wait != WAIT_DOWNLOAD:
+            await page.wait_for_timeout(PACING['settle_ms'])
 
     async def _perform_query(self, page, query_type, params):
-        """执行查询操作"""
-        save_path = None
+        """按查询计划执行查询操作"""
+        plan = QUERY_PLANS[query_type]
         try:
             # 准备表单
-            if not await self._prepare_form(page, query_type, params):
-                return []
-            
-            # 定义每个路由的点击序列
-            click_sequences = {
-                'glcx': [
-                    '#idNo',  # 点击身份证号输入框
-                    '#startDate',  # 点击开始日期
-                    '#endDate',  # 点击结束日期
-                    '#queryBtn',  # 查询按钮
-                    '#confirmBtn',  # 确认按钮（如果需要）
-                    '#download'  # 下载按钮
-                ],
-                'zzcx': [
-                    '#trainDate',
-                    '#boardTrainCode',
-                    '#fromStation',
-                    '#toStation',
-                    '#queryBtn',
-                    '#confirmBtn',
-                    '#download'
-                ],
-                'plgjcx': [
-                    '#startDate',
-                    '#endDate',
-                    '#queryBtn',
-                    '#confirmBtn',
-                    '#download'
-                ]
-            }
+            with metrics.span('prepare_form', query_type) as span:
+                if not await self._prepare_form(page, plan, params):
+                    span.outcome = 'error'
+                    raise QueryError(f"{query_type} 表单准备失败")
             
-            # 批量查询特殊处理 - 上传文件
-            if query_type == 'plgjcx':
-                # 生成ID列表文件
-                txt_path = os.path.join(self.data_dir, f'ids_{uuid.uuid4().hex}.txt')
-                with open(txt_path, 'w', encoding='utf-8') as f:
-                    for id_no in params['id_no_list']:
-                        f.write(id_no + '\n')
-                
-                try:
-                    # 上传文件
-                    file_input = await page.wait_for_selector('input[type=file]', timeout=10000)
-                    await file_input.set_input_files(txt_path)
-                    
-                    # 确保文件上传按钮在点击序列中
-                    if '#uploadBtn' not in click_sequences['plgjcx']:
-                        click_sequences['plgjcx'].insert(2, '#uploadBtn')
-                finally:
-                    if os.path.exists(txt_path):
-                        os.unlink(txt_path)
+            # 批量查询特殊处理 - 直接从内存生成ID列表文件并上传
+            if plan.upload_param:
+                id_file = {
+                    'name': 'ids.txt',
+                    'mimeType': 'text/plain',
+                    'buffer': ''.join(f'{id_no}\n' for id_no in params[plan.upload_param]).encode('utf-8')
+                }
+                file_input = await page.wait_for_selector('input[type=file]', timeout=10000)
+                await file_input.set_input_files(id_file)
             
-            # 创建下载事件监听
-            async with page.expect_download(timeout=self.timeout) as download_info:
-                # 执行路由特定的点击序列
-                for selector in click_sequences[query_type]:
-                    try:
-                        # 添加随机延迟模拟人工操作
-                        await asyncio.sleep(random.uniform(0.2, 0.5))
-                        
-                        # 更稳健的点击实现
-                        element = await page.wait_for_selector(selector, timeout=5000)
-                        await element.scroll_into_view_if_needed()
-                        box = await element.bounding_box()
-                        
-                        # 点击元素中心位置
-                        await page.mouse.click(
-                            box['x'] + box['width']/2,
-                            box['y'] + box['height']/2
-                        )
-                    except Exception as e:
-                        logger.warning(f"点击元素 {selector} 失败: {e}")
-                        # 尝试备用点击方法
-                        await page.click(selector, timeout=2000, force=True)
-                    
-                    # 等待操作完成（根据不同操作调整等待时间）
-                    if selector == '#uploadBtn':
-                        await page.wait_for_selector('.upload-success', timeout=30000)
-                    elif selector == '#download':
-                        await asyncio.sleep(1)  # 确保下载开始
-                    else:
-                        await page.wait_for_timeout(300)  # 短时间等待
-                    
-                    # 捕获并处理可能的弹窗
-                    page.on("dialog", lambda dialog: dialog.accept())
+            # 快速通道尚无模板时，录制本次点击发出的请求
+            template_key = RequestTemplate.key(query_type, params)
+            record = (
+                FAST_PATH_ENABLED
+                and plan.fast_path
+                and template_key not in self._request_templates
+            )
+            recorder = RequestRecorder(page)
+            
+            # 创建下载事件监听，并执行查询计划的点击序列
+            async with recorder if record else nullcontext(), \
+                    page.expect_download(timeout=self.timeout) as download_info:
+                with metrics.span('clicks', query_type):
+                    for step in plan.steps:
+                        await self._run_step(page, step)
+                download = await self._wait_download(download_info, query_type)
             
             # 处理下载的文件
-            download = await download_info.value
-            file_name = f"{query_type}_{uuid.uuid4().hex}.xlsx"
-            save_path = os.path.join(self.data_dir, file_name)
-            
-            # 保存文件并解析
-            await download.save_as(save_path)
-            processor = ExcelProcessor()
-            result = processor.read_file(save_path, query_type)
-            return result
-        except asyncio.TimeoutError:
+            if record:
+                template = recorder.build_template(download.url, params)
+                if template:
+                    self._request_templates[template_key] = template
+                    logger.info(f"已录制 {query_type} 导出请求模板 ({len(template.steps)} 个请求)")
+            
+            # 在解析池中解析下载文件
+            return await self._parse_download(download, query_type)
+        except QueryError:
+            raise
+        except (asyncio.TimeoutError, PlaywrightTimeoutError) as e:
             logger.error(f"等待下载超时 ({query_type})")
-            return []
+            raise QueryError(f"等待下载超时 ({query_type})") from e
         except Exception as e:
             logger.error(f"执行查询 {query_type} 失败: {e}")
             traceback.print_exc()
-            return []
-        finally:
-            # 清理临时文件
-            if save_path and os.path.exists(save_path):
+            raise QueryError(f"执行查询 {query_type} 失败: {e}") from e
+
+    async def _fetch_export(self, context, query_type, params):
+        """按录制的模板通过 context.request 直接请求导出接口，返回 None 表示回退到页面点击"""
+        template_key = RequestTemplate.key(query_type, params)
+        template = self._request_templates.get(template_key)
+        if template is None:
+            return None
+            
+        try:
+            with metrics.span('fetch_export', query_type):
+                responses = []
                 try:
-                    os.unlink(save_path)
-                except:
-                    pass
+                    for step in template.render(params):
+                        response = await context.request.fetch(
+                            step['url'],
+                            method=step['method'],
+                            headers=step['headers'],
+                            data=step['data'],
+                            timeout=self.timeout,
+                            ignore_https_errors=True
+                        )
+                        responses.append(response)
+                        if self._is_login_url(response.url) or response.status == 401:
+                            raise SessionExpiredError(f"{query_type} 导出请求返回 401 或被重定向到登录页")
+                        if not response.ok:
+                            raise RuntimeError(f"{step['method']} {response.url} 返回 {response.status}")
+                    
+                    body = await response.body()
+                finally:
+                    # 响应体会一直缓存在长期存活的上下文中，读取后立即释放
+                    await self._dispose(responses)
+                
+                # xlsx 是 zip 格式，以 PK 开头
+                if not body.startswith(b'PK'):
+                    raise RuntimeError("导出响应不是xlsx文件")
+            
+            return await self._parse_export(body, query_type)
+        except SessionExpiredError:
+            raise
+        except Exception as e:
+            logger.warning(f"{query_type} 快速通道失败，回退到页面点击: {e}")
+            metrics.inc('cyber_retries_total', query_type=query_type, reason='fast_path_fallback')
+            self._request_templates.pop(template_key, None)
+            return None
+
+    @staticmethod
+    async def _dispose(responses):
+        """释放 APIResponse 缓存的响应体"""
+        for response in responses:
+            try:
+                await response.dispose()
+            except Exception as e:
+                logger.debug(f"释放响应失败: {e}")
 
     async def execute_query(self, query_type, *args, **kwargs):
         """执行查询的统一入口"""
-        if not self._initialized:
-            await self.initialize()
+        plan = QUERY_PLANS.get(query_type)
+        if plan is None:
+            logger.error(f"未知的查询类型: {query_type}")
+            return []
             
         try:
-            # 为每个请求创建独立的上下文和页面
-            context = await self.browser.new_context(
-                ignore_https_errors=True,
-                accept_downloads=True,
-                viewport={'width': 1920, 'height': 1080}
+            return await self.run_query(query_type, plan.bind(args, kwargs))
+        except Exception as e:
+            logger.error(f"执行查询出错: {e}")
+            return []
+
+    async def run_query(self, query_type, params):
+        """经过结果缓存和并发合并执行查询，失败时抛出异常"""
+        key = ResultCache.make_key(query_type, params)
+        if cache_bypass.get():
+            metrics.inc('cyber_cache_requests_total', query_type=query_type, result='bypass')
+        else:
+            rows = self.cache.get(key)
+            metrics.inc(
+                'cyber_cache_requests_total', query_type=query_type,
+                result='miss' if rows is None else 'hit'
             )
-            page = await context.new_page()
-            page.on("dialog", lambda dialog: dialog.accept())
-            page.on("certificateerror", lambda error: error.continue_())
-            
-            # 确保登录
-            if not await self._ensure_login(page):
-                return []
+            if rows is not None:
+                logger.info(f"{query_type} 命中结果缓存")
+                return rows
                 
-            # 导航到查询页面
-            await page.goto(f'https://10.3.2.201:9943/rntibp/view/complex/{query_type}.html')
-            await page.wait_for_load_state('networkidle')
-            
-            # 准备参数
-            if query_type == 'glcx':
-                param_dict = {
-                    'date_start': args[0],
-                    'date_end': args[1],
-                    'id_no': args[2]
-                }
-            elif query_type == 'zzcx':
-                param_dict = {
-                    'train_date': args[0],
-                    'train_code': args[1],
-                    'from_station': args[2],
-                    'to_station': args[3] if len(args) > 3 else None
-                }
-            elif query_type == 'plgjcx':
-                param_dict = kwargs
+        # 相同参数的查询正在执行时直接等待其结果
+        return await self.inflight.do(key, lambda: self._run_and_cache(key, query_type, params))
+
+    async def _run_and_cache(self, key, query_type, params):
+        windows = self._date_windows(query_type, params)
+        if len(windows) > 1:
+            # 长日期范围拆成子区间并发查询，子区间各自经过缓存和并发合并
+            logger.info(f"{query_type} 日期范围拆分为 {len(windows)} 个子区间并发查询")
+            window_rows = await asyncio.gather(*(
+                self.run_query(query_type, {**params, 'date_start': start, 'date_end': end})
+                for start, end in windows
+            ))
+            rows = concat_rows(window_rows)
+        else:
+            rows = await self._run_query_uncached(query_type, params)
+        self.cache.put(key, query_type, rows)
+        return rows
+
+    @staticmethod
+    def _date_windows(query_type, params):
+        """按查询类型的拆分月数计算日期子区间"""
+        window_months = DATE_SPLIT_MONTHS.get(query_type, 0)
+        if not window_months or 'date_start' not in params:
+            return [(params.get('date_start'), params.get('date_end'))]
+        return split_date_range(params['date_start'], params['date_end'], window_months)
+
+    async def _run_query_uncached(self, query_type, params):
+        """登录并在页面池中执行查询"""
+        if not self._initialized:
+            await self.initialize()
             
-            # 执行查询
-            results = await self._perform_query(page, query_type, param_dict)
-            return results
+        # 会话在查询中途失效时重新登录并重试一次
+        with metrics.span('query', query_type):
+            for attempt in range(2):
+                if attempt:
+                    metrics.inc('cyber_retries_total', query_type=query_type, reason='session_expired')
+                session_version = await self.ensure_session()
+                try:
+                    return await self._execute_in_session(query_type, params)
+                except SessionExpiredError:
+                    self.invalidate_session(session_version)
+            raise QueryError(f"重新登录后会话仍然无效 ({query_type})")
+
+    async def _execute_in_session(self, query_type, param_dict):
+        """从页面池借出已登录的查询页并执行查询"""
+        fast_path = (
+            FAST_PATH_ENABLED
+            and QUERY_PLANS[query_type].fast_path
+            and RequestTemplate.key(query_type, param_dict) in self._request_templates
+        )
+        async with self.pool.checkout(query_type, reload=not fast_path) as entry:
+            if fast_path:
+                result = await self._fetch_export(entry.context, query_type, param_dict)
+                if result is not None:
+                    return result
+                await self.pool.reload_if_needed(entry)
+            return await self._perform_query(entry.page, query_type, param_dict)
+
+    # ====================== 预热与保活 ======================
+    async def prewarm(self):
+        """启动预热：启动浏览器、登录，并按 PREWARM_COUNTS 打开查询页面"""
+        self.prewarm_requested = True
+        self.prewarm_state.update(status='running', started_at=time.time(), finished_at=None, error=None)
+        try:
+            if not self._initialized:
+                await self.initialize()
+            await self.ensure_session()
+            pages = await self.pool.prewarm(PREWARM_COUNTS or self.pool.default_prewarm_counts())
         except Exception as e:
-            logger.error(f"执行查询出错: {e}")
-            return []
-        finally:
-            # 清理资源
-            if page:
-                await page.close()
-            if context:
-                await context.close()
+            logger.error(f"预热失败: {e}")
+            self.prewarm_state.update(status='failed', finished_at=time.time(), error=str(e))
+            return False
+        self.prewarm_state.update(status='done', finished_at=time.time(), pages=pages)
+        logger.info(f"预热完成，已打开 {pages} 个查询页面")
+        return True
+
+    async def keep_alive(self, interval):
+        """后台保活任务，按固定间隔执行直到事件循环关闭"""
+        while True:
+            await asyncio.sleep(interval)
+            self.keepalive_state['last_run'] = time.time()
+            try:
+                await self._keep_alive_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"保活任务执行失败: {e}")
+                self.keepalive_state['error'] = str(e)
+            else:
+                self.keepalive_state.update(last_ok=time.time(), error=None)
+
+    async def _keep_alive_once(self):
+        if not self._initialized:
+            # 浏览器断开后，启用了预热的实例主动恢复，而不是等待下一个请求
+            if self.prewarm_requested:
+                await self.prewarm()
+            return
+            
+        self.keepalive_state['recycled'] += await self.pool.recycle()
+        if await self.pool.ping() is False:
+            logger.warning("保活请求被重定向到登录页，会话已失效")
+            self.invalidate_session(self.session_version)
+        # 会话进入刷新窗口时提前重新登录
+        await self.ensure_session()
+        if self.prewarm_requested:
+            # 补足被回收或失效的页面
+            await self.pool.prewarm(PREWARM_COUNTS or self.pool.default_prewarm_counts())
+
+    def health(self):
+        """就绪状态：启用预热时，预热完成且浏览器可用后才算就绪"""
+        ready = not self.prewarm_requested or (
+            self._initialized and self.prewarm_state['status'] == 'done'
+        )
+        return {
+            'ready': ready,
+            'browser': self._initialized,
+            'session_valid': self._session_valid(),
+            'session_expires_in': max(int(self.session_expires_at - time.time()), 0) if self.storage_state else 0,
+            'pool': {'size': self.pool.size, 'open': self.pool.open_count(), 'idle': self.pool.idle_count()},
+            'prewarm': dict(self.prewarm_state, enabled=self.prewarm_requested),
+            'keepalive': dict(self.keepalive_state),
+        }
 
     # ====================== 独立路由处理 ======================
     async def handle_glcx(self, date_start, date_end, id_no):
@@ -634,35 +1954,259 @@ class PlaywrightAutomator:
 
     async def handle_plgjcx(self, date_start, date_end, id_no_list):
         """处理批量查询路由"""
-        return await self.execute_query(
-            'plgjcx',
-            date_start=date_start,
-            date_end=date_end,
-            id_no_list=id_no_list
-        )
+        result = await self.run_upload('plgjcx', {
+            'date_start': date_start,
+            'date_end': date_end,
+            'id_no_list': id_no_list
+        })
+        return result['rows']
+
+    async def run_upload(self, query_type, params, on_shard=None):
+        """把上传列表（plgjcx 的证件号列表）分片并发查询，按分片顺序拼接后返回结果和各分片的执行情况
+
+        on_shard(report, rows) 在每个分片完成时立即被调用，用于流式输出
+        """
+        upload_param = QUERY_PLANS[query_type].upload_param
+        # 重复的条目只上传一次
+        id_nos = list(dict.fromkeys(params[upload_param]))
+        shards = split_into_shards(id_nos, PLGJCX_SHARD_SIZE)
+        if len(shards) > 1:
+            logger.info(f"{query_type} 共 {len(id_nos)} 个条目，拆分为 {len(shards)} 个分片并发查询")
+        
+        async def run_shard(index, shard):
+            report = {'index': index, 'size': len(shard)}
+            try:
+                rows = await self.run_query(query_type, {**params, upload_param: shard})
+            except Exception as e:
+                logger.error(f"{query_type} 分片 {index} 查询失败: {e}")
+                report.update({'ok': False, 'rows': 0, 'error': str(e)})
+                if on_shard:
+                    on_shard(report, [])
+                return report, []
+            report.update({'ok': True, 'rows': len(rows)})
+            if on_shard:
+                on_shard(report, rows)
+            return report, rows
+        
+        results = await asyncio.gather(*(run_shard(idx, shard) for idx, shard in enumerate(shards)))
+        return {
+            'rows': concat_rows(rows for _, rows in results),
+            'shards': [report for report, _ in results]
+        }
+
+# ====================== 浏览器引擎 ======================
+class BrowserEngine:
+    """后台事件循环线程，持有进程级的自动化器实例"""
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.automator = None
+        self._ready = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """启动后台事件循环线程（幂等）"""
+        with self._start_lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self._ready.clear()
+            self.thread = threading.Thread(target=self._run, name='BrowserEngine', daemon=True)
+            self.thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        """事件循环线程主体，浏览器实例在此循环中创建和使用"""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.automator = PlaywrightAutomator()
+        logger.info("浏览器引擎事件循环已启动")
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            # 取消仍在等待的后台协程（如任务队列的工作协程）后再关闭循环
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.close()
+            logger.info("浏览器引擎事件循环已退出")
+
+    def submit(self, coro):
+        """提交协程到引擎事件循环，返回 concurrent.futures.Future"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """提交协程并阻塞等待结果"""
+        return self.submit(coro).result(timeout)
+
+    def shutdown(self):
+        """进程退出时关闭浏览器并停止事件循环"""
+        if not (self.thread and self.thread.is_alive()):
+            return
+        try:
+            if self.automator and self.automator.is_initialized():
+                logger.info("清理自动化器资源...")
+                self.run(self.automator.close(), timeout=30)
+        except Exception as e:
+            logger.error(f"关闭浏览器引擎时出错: {e}")
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=10)
+
+engine = BrowserEngine()
+atexit.register(engine.shutdown)
+
+# ====================== 异步任务 ======================
+class Job:
+    """一次异步提交的查询任务"""
+
+    def __init__(self, query_type, data):
+        self.id = uuid.uuid4().hex
+        self.query_type = query_type
+        self.data = data
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.progress = {
+            'items_total': len(data) if isinstance(data, list) else 1,
+            'items_done': 0,
+            'processed_rows': 0
+        }
+
+    def add_rows(self, count):
+        self.progress['processed_rows'] += count
+
+    async def track(self, awaitable):
+        """等待单个批量元素完成并计入进度"""
+        try:
+            return await awaitable
+        finally:
+            self.progress['items_done'] += 1
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'query_type': self.query_type,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'progress': dict(self.progress),
+            'error': self.error
+        }
+
+class JobManager:
+    """进程内的任务队列：固定数量的工作协程在浏览器引擎事件循环中依次执行任务"""
+
+    def __init__(self, workers, retention):
+        self.workers = workers
+        self.retention = retention
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue = None
+        self._worker_tasks = []
+
+    def submit(self, query_type, data):
+        """登记任务并投递到引擎事件循环，立即返回"""
+        job = Job(query_type, data)
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+        engine.submit(self._enqueue(job))
+        logger.info(f"已提交 {query_type} 异步任务 {job.id}")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._purge()
+            return self._jobs.get(job_id)
+
+    def queued_count(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def _purge(self):
+        """清理超过保留时间的已完成任务"""
+        deadline = time.time() - self.retention
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at is not None and job.finished_at < deadline
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    async def _enqueue(self, job):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._worker_tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        self._queue.put_nowait(job)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job):
+        job.status = 'running'
+        job.started_at = time.time()
+        current_job.set(job)
+        try:
+            job.result = await execute_route(job.query_type, job.data)
+            job.status = 'succeeded' if job.result.get('code') == 900 else 'failed'
+            if job.status == 'failed':
+                job.error = job.result.get('message')
+        except Exception as e:
+            logger.error(f"异步任务 {job.id} 执行失败: {e}")
+            traceback.print_exc()
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            current_job.set(None)
+            job.finished_at = time.time()
+            logger.info(f"异步任务 {job.id} 结束: {job.status}")
+
+jobs = JobManager(JOB_WORKERS, JOB_RETENTION)
 
 # ====================== Flask 应用和路由 ======================
 def get_automator():
-    """获取线程局部的自动化器实例"""
-    if not hasattr(_thread_local, 'automator'):
-        logger.info("创建新的自动化器实例")
-        _thread_local.automator = PlaywrightAutomator()
-    return _thread_local.automator
+    """获取进程级的自动化器实例"""
+    engine.start()
+    return engine.automator
+
+def _request_bypasses_cache():
+    """请求头 Cache-Control/Pragma 含 no-cache 时跳过结果缓存"""
+    directives = f"{request.headers.get('Cache-Control', '')},{request.headers.get('Pragma', '')}".lower()
+    return 'no-cache' in directives or 'no-store' in directives
+
+async def _run_in_request_context(ctx, f, args, kwargs):
+    """在引擎线程中恢复请求上下文并执行视图协程"""
+    with ctx:
+        cache_bypass.set(_request_bypasses_cache())
+        return await f(*args, **kwargs)
 
 def async_handler(f):
-    """将异步视图转换为同步视图的装饰器"""
+    """将异步视图提交到浏览器引擎事件循环执行的装饰器"""
     @wraps(f)
     def wrapper(*args, **kwargs):
         try:
-            return asyncio.run(f(*args, **kwargs))
+            ctx = request_ctx.copy()
+            return engine.run(_run_in_request_context(ctx, f, args, kwargs))
         except Exception as e:
             logger.error(f"Server Error: {str(e)}")
             traceback.print_exc()
             return make_response(jsonify({'code': 500, 'message': '服务器内部错误'}), 500)
     return wrapper
 
-async def validate_and_execute(data, required_fields, query_method):
-    """验证并执行查询逻辑"""
+def _validate_items(data, required_fields):
+    """校验批量请求体，返回错误响应，校验通过时返回 None"""
     if not isinstance(data, list):
         return {'code': 400, 'message': '请求数据必须是数组类型'}
     
@@ -674,11 +2218,25 @@ async def validate_and_execute(data, required_fields, query_method):
                 'code': 400,
                 'message': f'元素{idx}缺少必要字段: {", ".join(missing)}'
             }
+    return None
+
+def _plan_items(data, query_method):
+    """生成与请求元素一一对应的查询协程"""
+    tasks = [query_method(**item) for item in data]
+    job = current_job.get()
+    if job:
+        tasks = [job.track(task) for task in tasks]
+    return tasks
+
+async def validate_and_execute(data, required_fields, query_method):
+    """验证并执行查询逻辑"""
+    error = _validate_items(data, required_fields)
+    if error:
+        return error
     
     try:
         # 异步执行所有任务
-        tasks = [query_method(**item) for item in data]
-        results = await asyncio.gather(*tasks)
+        results = await asyncio.gather(*_plan_items(data, query_method))
         return {
             'code': 900,
             'data': results
@@ -691,6 +2249,34 @@ async def validate_and_execute(data, required_fields, query_method):
             'message': f'执行查询时发生错误: {str(e)}'
         }
 
+async def validate_and_stream(data, required_fields, query_method, emit):
+    """验证并执行查询逻辑，每个元素完成后立即以 {'index': 下标, ...} 的形式输出"""
+    error = _validate_items(data, required_fields)
+    if error:
+        emit(error)
+        return
+    
+    async def indexed(idx, awaitable):
+        try:
+            return idx, {'code': 900, 'data': await awaitable}
+        except Exception as e:
+            logger.error(f"执行第 {idx} 个查询时发生错误: {str(e)}")
+            return idx, {'code': 500, 'message': f'执行查询时发生错误: {str(e)}'}
+    
+    tasks = [
+        asyncio.ensure_future(indexed(idx, awaitable))
+        for idx, awaitable in enumerate(_plan_items(data, query_method))
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            idx, payload = await next_done
+            emit({'index': idx, **payload})
+    finally:
+        # 客户端断开时取消尚未完成的查询
+        for task in tasks:
+            task.cancel()
+    emit({'code': 900, 'done': True, 'count': len(tasks)})
+
 @app.route('/cyber/test', methods=['GET'])
 @async_handler
 async def test_endpoint():
@@ -710,62 +2296,276 @@ async def test_endpoint():
             'message': f'测试登录失败: {str(e)}'
         })
 
-@app.route('/cyber/glcx', methods=['POST'])
+@app.route('/cyber/health', methods=['GET'])
+def health_check():
+    """就绪检查，未就绪时返回 503；直接在请求线程中读取状态，不经过浏览器引擎事件循环"""
+    state = get_automator().health()
+    if not state['ready']:
+        return jsonify({
+            'code': 503,
+            'message': '服务尚未就绪',
+            'data': state
+        }), 503
+    return jsonify({
+        'code': 900,
+        'data': state
+    })
+
+@app.route('/cyber/cache', methods=['GET'])
 @async_handler
-async def glcx():
-    """个人查询路由"""
+async def cache_stats():
+    """结果缓存统计"""
     automator = get_automator()
-    data = request.get_json()
-    result = await validate_and_execute(data, ['date_start', 'date_end', 'id_no'], automator.handle_glcx)
-    return jsonify(result)
+    return jsonify({
+        'code': 900,
+        'data': automator.cache.stats()
+    })
 
-@app.route('/cyber/zzcx', methods=['POST'])
+@app.route('/cyber/resources', methods=['GET'])
 @async_handler
-async def zzcx():
-    """组织查询路由"""
+async def resource_stats():
+    """资源拦截统计"""
     automator = get_automator()
-    data = request.get_json()
-    result = await validate_and_execute(data, ['train_date', 'train_code', 'from_station', 'to_station'], automator.handle_zzcx)
-    return jsonify(result)
+    return jsonify({
+        'code': 900,
+        'data': dict(automator.resources.stats(), enabled=RESOURCE_BLOCKING_ENABLED)
+    })
+
+def _metric_gauges(automator):
+    """采集时读取的页面池、缓存和任务队列状态"""
+    pool = automator.pool
+    cache = automator.cache.stats()
+    resources = automator.resources.stats()
+    return [
+        ('cyber_pool_size', 'gauge', '页面池容量', {}, pool.size),
+        ('cyber_pool_open', 'gauge', '已打开的查询页面数', {}, pool.open_count()),
+        ('cyber_pool_idle', 'gauge', '空闲的查询页面数', {}, pool.idle_count()),
+        ('cyber_inflight_queries', 'gauge', '正在执行的去重查询数', {}, automator.inflight.in_flight()),
+        ('cyber_cache_entries', 'gauge', '结果缓存条数', {}, cache['entries']),
+        ('cyber_cache_bytes', 'gauge', '结果缓存字节数', {}, cache['bytes']),
+        ('cyber_cache_evictions_total', 'counter', '结果缓存淘汰次数', {}, cache['evictions']),
+        ('cyber_resource_requests_total', 'counter', '浏览器资源请求数', {'action': 'allowed'}, resources['allowed']),
+        ('cyber_resource_requests_total', 'counter', '浏览器资源请求数', {'action': 'blocked'}, resources['blocked']),
+        ('cyber_parse_queue_depth', 'gauge', '等待或正在解析的导出文件数', {}, automator.parser.pending),
+        ('cyber_parse_workers', 'gauge', '解析进程（线程）数', {'mode': automator.parser.mode}, automator.parser.workers),
+        ('cyber_jobs_queued', 'gauge', '排队中的异步任务数', {}, jobs.queued_count()),
+    ]
 
-@app.route('/cyber/plgjcx', methods=['POST'])
+@app.route('/cyber/metrics', methods=['GET'])
 @async_handler
-async def plgjcx():
-    """批量查询路由"""
-    automator = get_automator()
-    data = request.get_json()
-    
-    # 增强参数验证
-    if not all(key in data for key in ['date_start', 'date_end']):
-        return jsonify({
+async def metrics_endpoint():
+    """Prometheus 文本格式的指标"""
+    text = metrics.render(_metric_gauges(get_automator()))
+    return Response(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+QUERY_TYPES = tuple(QUERY_PLANS)
+
+def _validate_upload(plan, data):
+    """校验上传列表类查询（plgjcx）的请求体，返回错误响应，校验通过时返回 None"""
+    fields = [arg for arg in plan.required_args if arg != plan.upload_param]
+    if not isinstance(data, dict) or not all(key in data for key in fields):
+        return {
             'code': 400,
-            'message': '请求数据必须包含 date_start 和 date_end 字段'
-        })
+            'message': f'请求数据必须包含 {" 和 ".join(fields)} 字段'
+        }
     
-    if not isinstance(data.get('id_no_list'), list):
-        return jsonify({
+    if not isinstance(data.get(plan.upload_param), list):
+        return {
             'code': 400,
-            'message': 'id_no_list 必须是数组类型'
-        })
+            'message': f'{plan.upload_param} 必须是数组类型'
+        }
+    return None
+
+async def execute_upload(plan, data):
+    """验证并执行上传列表类查询"""
+    automator = get_automator()
+    error = _validate_upload(plan, data)
+    if error:
+        return error
     
-    # 执行批量查询
+    # 执行批量查询（大列表自动分片并发）
     try:
-        results = await automator.handle_plgjcx(
-            date_start=data['date_start'],
-            date_end=data['date_end'],
-            id_no_list=data['id_no_list']
-        )
-        return jsonify({
+        result = await automator.run_upload(plan.query_type, plan.select(data))
+        job = current_job.get()
+        if job:
+            job.progress['items_done'] = 1
+        return {
             'code': 900,
-            'data': results
-        })
+            'data': result['rows'],
+            'shards': result['shards']
+        }
     except Exception as e:
         logger.error(f"批量查询执行失败: {str(e)}")
         traceback.print_exc()
-        return jsonify({
+        return {
             'code': 500,
             'message': f'批量查询执行失败: {str(e)}'
+        }
+
+async def stream_upload(plan, data, emit):
+    """验证并执行上传列表类查询，每个分片完成后立即输出该分片的全部行（分片之间没有重叠，不去重）"""
+    automator = get_automator()
+    error = _validate_upload(plan, data)
+    if error:
+        emit(error)
+        return
+    
+    count = 0
+    
+    def on_shard(report, rows):
+        nonlocal count
+        count += len(rows)
+        for row in rows:
+            emit({'shard': report['index'], 'data': row})
+        emit({'shard': report['index'], 'report': report})
+    
+    result = await automator.run_upload(plan.query_type, plan.select(data), on_shard=on_shard)
+    emit({'code': 900, 'done': True, 'count': count, 'shards': result['shards']})
+
+def _item_method(plan):
+    """按查询计划得到单个请求元素的查询方法"""
+    automator = get_automator()
+    
+    def query_method(**item):
+        return automator.execute_query(plan.query_type, **plan.select(item))
+    
+    return query_method
+
+async def execute_route(query_type, data):
+    """执行一个查询路由的请求体，返回响应数据（同步路由与异步任务共用）"""
+    plan = QUERY_PLANS.get(query_type)
+    if plan is None:
+        return {'code': 404, 'message': f'未知的查询类型: {query_type}'}
+    if plan.upload_param:
+        return await execute_upload(plan, data)
+    return await validate_and_execute(data, plan.required_args, _item_method(plan))
+
+async def stream_route(query_type, data, emit):
+    """以流式方式执行一个查询路由，结果通过 emit 逐条输出"""
+    plan = QUERY_PLANS.get(query_type)
+    if plan is None:
+        emit({'code': 404, 'message': f'未知的查询类型: {query_type}'})
+    elif plan.upload_param:
+        await stream_upload(plan, data, emit)
+    else:
+        await validate_and_stream(data, plan.required_args, _item_method(plan), emit)
+
+_STREAM_END = object()
+
+def stream_response(query_type, data):
+    """在引擎事件循环中执行查询，并以 application/x-ndjson 分块响应逐行输出结果"""
+    lines = queue.Queue()
+    bypass = _request_bypasses_cache()
+    
+    async def produce():
+        cache_bypass.set(bypass)
+        try:
+            await stream_route(query_type, data, lines.put)
+        except Exception as e:
+            logger.error(f"流式查询执行失败: {str(e)}")
+            traceback.print_exc()
+            lines.put({'code': 500, 'message': f'执行查询时发生错误: {str(e)}'})
+        finally:
+            lines.put(_STREAM_END)
+    
+    future = engine.submit(produce())
+    
+    def generate():
+        try:
+            while True:
+                item = lines.get()
+                if item is _STREAM_END:
+                    break
+                yield dumps_json(item) + b'\n'
+        finally:
+            # 客户端断开连接时停止查询
+            future.cancel()
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@async_handler
+async def _execute_route_payload(query_type, data):
+    return await execute_route(query_type, data)
+
+def render_result(query_type, payload):
+    """按 ?format=json|columnar|csv 和 Accept-Encoding 在请求线程中序列化查询结果"""
+    plan = QUERY_PLANS.get(query_type)
+    return render(
+        payload,
+        request.args.get('format'),
+        request.headers.get('Accept-Encoding'),
+        # 上传证件号列表的查询（plgjcx）返回单个结果集，其余查询按请求元素返回结果集列表
+        batch=plan is not None and not plan.upload_param,
+        columns=list(plan.columns) if plan else None
+    )
+
+def dispatch_route(query_type):
+    """?stream=1 时返回 NDJSON 流式响应，否则等待全部完成后按请求的格式返回"""
+    data = request.get_json()
+    if request.args.get('stream') in ('1', 'true'):
+        return stream_response(query_type, data)
+    payload = _execute_route_payload(query_type, data)
+    if not isinstance(payload, dict):
+        # async_handler 已生成错误响应
+        return payload
+    return render_result(query_type, payload)
+
+@app.route(f"/cyber/<any({', '.join(QUERY_TYPES)}):query_type>", methods=['POST'])
+def query_route(query_type):
+    """查询路由，每个查询计划对应一个 /cyber/<query_type>"""
+    return dispatch_route(query_type)
+
+# ====================== 异步任务路由 ======================
+# 任务状态直接在请求线程中读取，不经过浏览器引擎事件循环，解析大文件时也能及时响应
+@app.route('/cyber/jobs/<query_type>', methods=['POST'])
+def submit_job(query_type):
+    """提交异步查询任务，立即返回任务ID"""
+    if query_type not in QUERY_TYPES:
+        return jsonify({
+            'code': 404,
+            'message': f'未知的查询类型: {query_type}'
+        }), 404
+    job = jobs.submit(query_type, request.get_json())
+    return jsonify({
+        'code': 900,
+        'data': job.to_dict()
+    })
+
+@app.route('/cyber/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """查询任务状态和进度"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({
+            'code': 404,
+            'message': '任务不存在或已过期'
+        }), 404
+    return jsonify({
+        'code': 900,
+        'data': job.to_dict()
+    })
+
+@app.route('/cyber/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """获取已完成任务的结果"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({
+            'code': 404,
+            'message': '任务不存在或已过期'
+        }), 404
+    if job.finished_at is None:
+        return jsonify({
+            'code': 202,
+            'message': '任务尚未完成',
+            'data': job.to_dict()
+        }), 202
+    if job.result is None:
+        return jsonify({
+            'code': 500,
+            'message': f'任务执行失败: {job.error}'
         })
+    return render_result(job.query_type, job.result)
 
 # ====================== 错误处理和清理 ======================
 @app.errorhandler(404)
@@ -789,18 +2589,30 @@ def internal_error(e):
         'message': '服务器内部错误'
     }), 500
 
-@app.teardown_appcontext
-def cleanup(resp_or_exc):
-    """应用退出时清理资源"""
-    if hasattr(_thread_local, 'automator'):
-        automator = _thread_local.automator
-        if automator.is_initialized():
-            logger.info("清理自动化器资源...")
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(automator.close())
-            loop.close()
-        del _thread_local.automator
+def main():
+    parser = argparse.ArgumentParser(description='查询自动化服务')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='工作进程数；大于 1 时由前置分发器监听 --port，工作进程使用其后的连续端口')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='启动时预先启动浏览器、登录并打开查询页面，完成前 /cyber/health 返回 503')
+    args = parser.parse_args()
+    
+    if args.workers > 1:
+        from supervisor import run_supervisor
+        run_supervisor(
+            args.workers, args.host, args.port, os.path.abspath(__file__),
+            worker_args=['--prewarm'] if args.prewarm else []
+        )
+        return
+        
+    automator = get_automator()
+    if args.prewarm:
+        engine.submit(automator.prewarm())
+    if KEEPALIVE_INTERVAL > 0:
+        engine.submit(automator.keep_alive(KEEPALIVE_INTERVAL))
+    app.run(host=args.host, port=args.port, threaded=True)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""本地模拟门户，提供与真实门户相同的登录页、查询表单和 xlsx 导出，用于离线压测
+
+用法: python mock_portal.py --port 9943 --rows 200 --query-latency 0.2 --export-latency 0.5
+然后以 PORTAL_BASE_URL=http://127.0.0.1:9943/rntibp 启动 index.py
+"""
+import argparse
+import hashlib
+import io
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import openpyxl
+from flask import Flask, Response, abort, make_response, redirect, request, jsonify
+
+PREFIX = '/rntibp'
+SESSION_COOKIE = 'MOCKSESSIONID'
+
+app = Flask(__name__)
+app.config['JSON_AS_ASCII'] = False
+
+# 运行参数，由命令行覆盖
+settings = {
+    'rows': 100,
+    'rows_per_id': 2,
+    'query_latency': 0.0,
+    'export_latency': 0.0,
+    'session_ttl': 0,
+}
+_sessions = {}
+_uploads = {}
+_lock = threading.Lock()
+
+# 导出表头（与 ExcelProcessor.COLUMN_MAPPING 的标准列名一致）
+HEADERS = {
+    'glcx': ['业务类型', '姓名', '证件类型', '证件编号', '乘车日期', '乘车时间', '车次',
+             '发站', '到站', '车厢号', '席别', '座位号', '票价'],
+    'zzcx': ['姓名', '证件类型', '证件编号', '乘车日期', '乘车时间', '票号', '车次', '发站',
+             '到站', '车厢号', '席别', '座位号', '票种', '票价', '售票处', '窗口', '操作员', '售票时间'],
+    'plgjcx': ['姓名', '证件类型', '证件编号', '乘车日期', '乘车时间', '车次', '发站', '到站',
+               '车厢号', '席别', '座位号', '票价'],
+}
+
+# 各查询页的表单字段：(id, name, 是否只读)
+FORM_FIELDS = {
+    'glcx': [('startDate', 'startDate', True), ('endDate', 'endDate', True), ('idNo', 'idNo', False)],
+    'zzcx': [('trainDate', 'trainDate', True), ('boardTrainCode', 'boardTrainCode', False),
+             ('fromStation', 'fromStation', False), ('toStation', 'toStation', False)],
+    'plgjcx': [('startDate', 'startDate', True), ('endDate', 'endDate', True)],
+}
+
+STATIONS = ['北京南', '上海虹桥', '广州南', '深圳北', '杭州东', '南京南', '武汉', '成都东']
+SEATS = ['二等座', '一等座', '商务座', '硬卧', '软卧', '无座']
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>模拟门户 - 登录</title></head>
+<body>
+<form method="post" action="login">
+  <input type="password" name="password">
+  <button id="loginBtn" type="submit">登录</button>
+</form>
+</body></html>"""
+
+DASHBOARD_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>模拟门户</title></head>
+<body><div class="dashboard">首页</div></body></html>"""
+
+QUERY_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>模拟门户 - {query_type}</title></head>
+<body>
+<div class="main-padding">
+  <form class="query-form" onsubmit="return false">
+    {fields}
+    {upload}
+  </form>
+  <button id="queryBtn" type="button">查询</button>
+  <div id="confirmDialog" style="display:none">共 <span id="total"></span> 条
+    <button id="confirmBtn" type="button">确定</button>
+  </div>
+  <a id="download" style="display:none" download>导出</a>
+</div>
+<script>
+const queryType = '{query_type}';
+let uploadToken = '';
+function formParams() {{
+  const params = new URLSearchParams();
+  document.querySelectorAll('.query-form input[name]').forEach(input => params.append(input.name, input.value));
+  if (uploadToken) params.append('token', uploadToken);
+  return params;
+}}
+document.getElementById('queryBtn').onclick = async () => {{
+  document.getElementById('download').style.display = 'none';
+  const response = await fetch('../../api/' + queryType + '/query', {{
+    method: 'POST',
+    headers: {{'Content-Type': 'application/x-www-form-urlencoded'}},
+    body: formParams().toString()
+  }});
+  const result = await response.json();
+  document.getElementById('total').textContent = result.total;
+  document.getElementById('confirmDialog').style.display = 'block';
+}};
+document.getElementById('confirmBtn').onclick = () => {{
+  document.getElementById('confirmDialog').style.display = 'none';
+  const link = document.getElementById('download');
+  link.href = '../../api/' + queryType + '/export?' + formParams().toString();
+  link.style.display = 'inline';
+}};
+const uploadBtn = document.getElementById('uploadBtn');
+if (uploadBtn) {{
+  uploadBtn.onclick = async () => {{
+    document.querySelector('.upload-success').style.display = 'none';
+    const body = new FormData();
+    body.append('file', document.querySelector('input[type=file]').files[0]);
+    const response = await fetch('../../api/upload', {{method: 'POST', body}});
+    uploadToken = (await response.json()).token;
+    document.querySelector('.upload-success').style.display = 'inline';
+  }};
+}}
+</script>
+</body></html>"""
+
+UPLOAD_FIELDS = """<input type="file" name="idFile">
+    <button id="uploadBtn" type="button">上传</button>
+    <span class="upload-success" style="display:none">上传成功</span>"""
+
+def _logged_in():
+    """当前请求是否带有未过期的会话"""
+    token = request.cookies.get(SESSION_COOKIE)
+    with _lock:
+        expires_at = _sessions.get(token)
+    return expires_at is not None and (expires_at == 0 or time.time() < expires_at)
+
+def _parse_date(text, default):
+    for fmt in ('%Y-%m-%d', '%Y%m%d', '%Y/%m/%d'):
+        try:
+            return datetime.strptime((text or '').strip(), fmt)
+        except ValueError:
+            continue
+    return default
+
+def _make_rows(query_type, form, id_nos):
+    """按查询参数生成确定性的结果行，同样的参数总是得到同样的结果"""
+    seed = hashlib.md5(repr((query_type, sorted(form.items()), id_nos)).encode('utf-8')).hexdigest()
+    rng = random.Random(seed)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = _parse_date(form.get('startDate') or form.get('trainDate'), today)
+    end = _parse_date(form.get('endDate') or form.get('trainDate'), start)
+    span_days = max((end - start).days, 0) + 1
+
+    if query_type == 'plgjcx':
+        owners = [id_no for id_no in id_nos for _ in range(settings['rows_per_id'])]
+    else:
+        owners = [form.get('idNo') or f'1101011990{rng.randrange(10 ** 8):08d}' for _ in range(settings['rows'])]
+
+    for id_no in owners:
+        travel = start + timedelta(days=rng.randrange(span_days), minutes=rng.randrange(1440))
+        values = {
+            '业务类型': '售票',
+            '姓名': f'乘客{rng.randrange(2000)}',
+            '证件类型': '身份证',
+            '证件编号': id_no,
+            '乘车日期': travel.strftime('%Y-%m-%d'),
+            '乘车时间': travel.strftime('%H:%M'),
+            '票号': f'E{rng.randrange(10 ** 9):09d}',
+            '车次': form.get('boardTrainCode') or f'G{rng.randrange(1, 9999)}',
+            '发站': form.get('fromStation') or rng.choice(STATIONS),
+            '到站': form.get('toStation') or rng.choice(STATIONS),
+            '车厢号': f'{rng.randrange(1, 17):02d}',
+            '席别': rng.choice(SEATS),
+            '座位号': f'{rng.randrange(1, 20):02d}{rng.choice("ABCDF")}',
+            '票种': '成人票',
+            '票价': float(rng.randrange(50, 2000)),
+            '售票处': rng.choice(STATIONS),
+            '窗口': f'{rng.randrange(1, 30):03d}',
+            '操作员': f'{rng.randrange(10 ** 5):05d}',
+            '售票时间': (travel - timedelta(days=rng.randrange(15))).strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        yield [values[column] for column in HEADERS[query_type]]
+
+def _build_workbook(query_type, rows):
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(HEADERS[query_type])
+    for row in rows:
+        sheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+@app.route(f'{PREFIX}/login.html')
+def login_page():
+    return LOGIN_PAGE
+
+@app.route(f'{PREFIX}/login', methods=['POST'])
+def login():
+    token = uuid.uuid4().hex
+    ttl = settings['session_ttl']
+    with _lock:
+        _sessions[token] = time.time() + ttl if ttl else 0
+    response = make_response(redirect(f'{PREFIX}/index.html'))
+    response.set_cookie(SESSION_COOKIE, token, path=PREFIX)
+    return response
+
+@app.route(f'{PREFIX}/index.html')
+def dashboard():
+    if not _logged_in():
+        return redirect(f'{PREFIX}/login.html')
+    return DASHBOARD_PAGE
+
+@app.route(f'{PREFIX}/view/complex/<query_type>.html')
+def query_page(query_type):
+    if query_type not in HEADERS:
+        abort(404)
+    if not _logged_in():
+        return redirect(f'{PREFIX}/login.html')
+    fields = '\n    '.join(
+        f'<input id="{field_id}" name="{name}"{" readonly" if readonly else ""}>'
+        for field_id, name, readonly in FORM_FIELDS[query_type]
+    )
+    return QUERY_PAGE.format(
+        query_type=query_type,
+        fields=fields,
+        upload=UPLOAD_FIELDS if query_type == 'plgjcx' else ''
+    )
+
+@app.route(f'{PREFIX}/api/upload', methods=['POST'])
+def upload():
+    if not _logged_in():
+        return jsonify({'message': '未登录'}), 401
+    content = request.files['file'].read().decode('utf-8')
+    token = uuid.uuid4().hex
+    with _lock:
+        _uploads[token] = [line.strip() for line in content.splitlines() if line.strip()]
+    return jsonify({'token': token, 'count': len(_uploads[token])})
+
+@app.route(f'{PREFIX}/api/<query_type>/query', methods=['POST'])
+def query(query_type):
+    if query_type not in HEADERS:
+        abort(404)
+    if not _logged_in():
+        return jsonify({'message': '未登录'}), 401
+    time.sleep(settings['query_latency'])
+    with _lock:
+        id_nos = _uploads.get(request.form.get('token'), [])
+    total = len(id_nos) * settings['rows_per_id'] if query_type == 'plgjcx' else settings['rows']
+    return jsonify({'total': total})
+
+@app.route(f'{PREFIX}/api/<query_type>/export')
+def export(query_type):
+    if query_type not in HEADERS:
+        abort(404)
+    if not _logged_in():
+        return redirect(f'{PREFIX}/login.html')
+    time.sleep(settings['export_latency'])
+    form = request.args.to_dict()
+    token = form.pop('token', None)
+    with _lock:
+        id_nos = list(_uploads.get(token, []))
+    content = _build_workbook(query_type, _make_rows(query_type, form, id_nos))
+    return Response(
+        content,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        headers={'Content-Disposition': f'attachment; filename={query_type}.xlsx'}
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟门户')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9943)
+    parser.add_argument('--rows', type=int, default=settings['rows'], help='glcx/zzcx 每次导出的行数')
+    parser.add_argument('--rows-per-id', type=int, default=settings['rows_per_id'], help='plgjcx 每个证件号的行数')
+    parser.add_argument('--query-latency', type=float, default=0.0, help='查询接口延迟（秒）')
+    parser.add_argument('--export-latency', type=float, default=0.0, help='导出接口延迟（秒）')
+    parser.add_argument('--session-ttl', type=int, default=0, help='会话有效期（秒，0 表示不过期）')
+    args = parser.parse_args()
+
+    settings.update(
+        rows=args.rows,
+        rows_per_id=args.rows_per_id,
+        query_latency=args.query_latency,
+        export_latency=args.export_latency,
+        session_ttl=args.session_ttl,
+    )
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
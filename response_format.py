@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""查询结果的响应格式（json / columnar / csv）与压缩协商，服务和多进程分发器共用
+
+- json: 默认格式，与原有响应结构一致，使用更快的编码器（安装了 orjson 时使用 orjson）
+- columnar: 每个结果集为 {'columns': [...], 'rows': [[...], ...]}，不再逐行重复列名
+- csv: 带 BOM 的 UTF-8 CSV，批量查询多一列“序号”表示结果所属的请求元素
+"""
+import csv
+import gzip
+import io
+import json
+import os
+from operator import itemgetter
+
+from flask import Response, jsonify
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMATS = ('json', 'columnar', 'csv')
+# 响应体小于该字节数时不压缩
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+ZSTD_LEVEL = int(os.environ.get('ZSTD_LEVEL', 3))
+BATCH_INDEX_COLUMN = '序号'
+
+def dumps_json(obj):
+    """序列化为 UTF-8 JSON 字节串，非 ASCII 字符不转义"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+
+def _infer_columns(result_sets):
+    for rows in result_sets:
+        if rows:
+            return list(rows[0])
+    return []
+
+def _row_getter(columns):
+    """按列顺序取行值；缺少的列取 None"""
+    if not columns:
+        return lambda row: []
+    getter = itemgetter(*columns)
+    single = len(columns) == 1
+
+    def values(row):
+        try:
+            result = getter(row)
+        except KeyError:
+            return [row.get(column) for column in columns]
+        return [result] if single else result
+    return values
+
+def _result_sets(payload, batch):
+    data = payload.get('data') or []
+    return data if batch else [data]
+
+def to_columnar(payload, batch, columns=None):
+    """把行字典列表转换为列名 + 行数组"""
+    result_sets = _result_sets(payload, batch)
+    columns = list(columns) if columns else _infer_columns(result_sets)
+    values = _row_getter(columns)
+    converted = [
+        {'columns': columns, 'rows': [values(row) for row in rows or []]}
+        for rows in result_sets
+    ]
+    return dict(payload, data=converted if batch else converted[0])
+
+def to_csv(payload, batch, columns=None):
+    """把查询结果转换为 CSV 字节串"""
+    result_sets = _result_sets(payload, batch)
+    columns = list(columns) if columns else _infer_columns(result_sets)
+    values = _row_getter(columns)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(([BATCH_INDEX_COLUMN] if batch else []) + columns)
+    for idx, rows in enumerate(result_sets):
+        prefix = [idx] if batch else []
+        writer.writerows(prefix + list(values(row)) for row in rows or [])
+    return buffer.getvalue().encode('utf-8-sig')
+
+def negotiate_encoding(accept_encoding):
+    """按 Accept-Encoding 选择压缩方式：zstd（已安装 zstandard 时）优先于 gzip"""
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    if zstandard is not None and accepted.get('zstd', 0) > 0:
+        return 'zstd'
+    if accepted.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+def compress(body, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
+
+def render(payload, fmt='json', accept_encoding=None, batch=False, columns=None):
+    """按请求的格式和压缩方式生成响应；错误响应始终为 JSON"""
+    fmt = (fmt or 'json').lower()
+    if fmt not in FORMATS:
+        return jsonify({
+            'code': 400,
+            'message': f"不支持的格式: {fmt}，可选 {', '.join(FORMATS)}"
+        })
+
+    if payload.get('code') != 900:
+        body, content_type = dumps_json(payload), 'application/json'
+    elif fmt == 'csv':
+        body, content_type = to_csv(payload, batch, columns), 'text/csv; charset=utf-8'
+    elif fmt == 'columnar':
+        body, content_type = dumps_json(to_columnar(payload, batch, columns)), 'application/json'
+    else:
+        body, content_type = dumps_json(payload), 'application/json'
+
+    response = Response(content_type=content_type)
+    response.headers['Vary'] = 'Accept-Encoding'
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= COMPRESS_MIN_BYTES else None
+    if encoding:
+        body = compress(body, encoding)
+        response.headers['Content-Encoding'] = encoding
+    response.set_data(body)
+    return response
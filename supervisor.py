@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""多进程模式：启动 N 个 index.py 工作进程（各自持有浏览器和事件循环），前置分发器按未完成工作量分发请求
+
+用法: python index.py --workers 4 --port 5000
+工作进程监听 127.0.0.1 上 port+1 起的连续端口，分发器监听 port
+"""
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, Response, request, jsonify
+
+from response_format import render
+
+logger = logging.getLogger('AutomationServer.supervisor')
+
+# 工作进程健康检查间隔（秒）和超时
+HEALTH_INTERVAL = float(os.environ.get('WORKER_HEALTH_INTERVAL', 5))
+HEALTH_TIMEOUT = float(os.environ.get('WORKER_HEALTH_TIMEOUT', 5))
+# 工作进程退出后重启的最长退避时间（秒）
+RESTART_BACKOFF_MAX = float(os.environ.get('WORKER_RESTART_BACKOFF_MAX', 30))
+# 转发到工作进程的请求超时（秒）
+PROXY_TIMEOUT = float(os.environ.get('WORKER_PROXY_TIMEOUT', 600))
+# 转发时保留的请求头
+FORWARDED_HEADERS = ('Content-Type', 'Cache-Control', 'Pragma', 'Accept', 'Accept-Encoding')
+# 从工作进程响应中保留的响应头
+PASSED_RESPONSE_HEADERS = ('Content-Encoding', 'Vary')
+# 按条目拆分到多个工作进程的批量查询
+SPLIT_QUERY_TYPES = ('glcx', 'zzcx')
+# 就绪检查路径，工作进程预热完成前返回 503
+HEALTH_PATH = '/cyber/health'
+
+class Worker:
+    """一个工作进程及其状态"""
+
+    def __init__(self, index, port):
+        self.index = index
+        self.port = port
+        self.process = None
+        self.status = 'stopped'
+        self.outstanding = 0
+        self.started_at = None
+        self.restarts = 0
+        self.last_exit_code = None
+        self.last_check = None
+        self.last_error = None
+        self.health_latency = None
+        self.next_start_at = 0
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    @property
+    def available(self):
+        return self.status == 'up'
+
+    def to_dict(self):
+        return {
+            'index': self.index,
+            'port': self.port,
+            'pid': self.process.pid if self.process else None,
+            'status': self.status,
+            'outstanding': self.outstanding,
+            'started_at': self.started_at,
+            'restarts': self.restarts,
+            'last_exit_code': self.last_exit_code,
+            'last_check': self.last_check,
+            'health_latency_ms': round(self.health_latency * 1000, 1) if self.health_latency is not None else None,
+            'last_error': self.last_error,
+        }
+
+class Supervisor:
+    """启动并监控工作进程，崩溃后按退避时间重启，定期检查健康状态"""
+
+    def __init__(self, workers, base_port, script, worker_args=()):
+        self.workers = [Worker(idx, base_port + 1 + idx) for idx in range(workers)]
+        self.script = script
+        self.worker_args = list(worker_args)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def _worker_env(self, worker):
+        env = dict(os.environ, WORKER_ID=str(worker.index))
+        # 解析进程按工作进程数平分 CPU
+        env.setdefault('PARSE_WORKERS', str(max(1, (os.cpu_count() or 1) // len(self.workers))))
+        return env
+
+    def _spawn(self, worker):
+        worker.process = subprocess.Popen(
+            [sys.executable, self.script, '--host', '127.0.0.1', '--port', str(worker.port)] + self.worker_args,
+            env=self._worker_env(worker)
+        )
+        worker.status = 'starting'
+        worker.started_at = time.time()
+        worker.last_error = None
+        logger.info(f"工作进程 {worker.index} 已启动 (pid {worker.process.pid}, 端口 {worker.port})")
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        for target in (self._monitor, self._health_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _monitor(self):
+        """发现退出的工作进程并按退避时间重启"""
+        while not self._stopping.wait(1):
+            for worker in self.workers:
+                code = worker.process.poll() if worker.process else None
+                if worker.status != 'restarting' and code is not None:
+                    with self._lock:
+                        worker.last_exit_code = code
+                        worker.status = 'restarting'
+                        # 运行超过一分钟后再崩溃的进程重新从最短退避开始
+                        if time.time() - (worker.started_at or 0) > 60:
+                            worker.restarts = 0
+                        backoff = min(RESTART_BACKOFF_MAX, 2 ** worker.restarts)
+                        worker.restarts += 1
+                        worker.next_start_at = time.time() + backoff
+                    logger.error(f"工作进程 {worker.index} 已退出 (退出码 {code})，{backoff:.0f} 秒后重启")
+                if worker.status == 'restarting' and time.time() >= worker.next_start_at:
+                    with self._lock:
+                        self._spawn(worker)
+
+    def _check(self, worker):
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(worker.base_url + HEALTH_PATH, timeout=HEALTH_TIMEOUT) as response:
+                healthy = response.status == 200
+            worker.last_error = None if healthy else f'HTTP {response.status}'
+        except (urllib.error.URLError, OSError) as e:
+            healthy = False
+            worker.last_error = str(e)
+        worker.health_latency = time.perf_counter() - started
+        worker.last_check = time.time()
+        with self._lock:
+            if worker.status in ('starting', 'up', 'down'):
+                worker.status = 'up' if healthy else ('starting' if worker.status == 'starting' else 'down')
+
+    def _health_loop(self):
+        while True:
+            for worker in self.workers:
+                if worker.status != 'restarting':
+                    self._check(worker)
+            if self._stopping.wait(HEALTH_INTERVAL):
+                return
+
+    def acquire(self, weight=1, exclude=()):
+        """选择未完成工作量最少的可用工作进程，并计入本次工作量"""
+        with self._lock:
+            candidates = [worker for worker in self.workers if worker.available and worker not in exclude]
+            if not candidates:
+                return None
+            worker = min(candidates, key=lambda item: (item.outstanding, item.index))
+            worker.outstanding += weight
+            return worker
+
+    def assign(self, count):
+        """把 count 个条目贪心分配给工作进程，返回 [(worker, 条目下标列表)]，各进程的工作量已计入"""
+        with self._lock:
+            candidates = [worker for worker in self.workers if worker.available]
+            if not candidates:
+                return []
+            load = {worker.index: worker.outstanding for worker in candidates}
+            plan = {}
+            for idx in range(count):
+                worker = min(candidates, key=lambda item: (load[item.index], item.index))
+                load[worker.index] += 1
+                plan.setdefault(worker.index, (worker, []))[1].append(idx)
+            for worker, indices in plan.values():
+                worker.outstanding += len(indices)
+            return list(plan.values())
+
+    def release(self, worker, weight=1):
+        with self._lock:
+            worker.outstanding -= weight
+
+    def get(self, index):
+        if 0 <= index < len(self.workers):
+            return self.workers[index]
+        return None
+
+    def health(self):
+        with self._lock:
+            workers = [worker.to_dict() for worker in self.workers]
+        return {
+            'workers': workers,
+            'available': sum(1 for worker in workers if worker['status'] == 'up'),
+            'total': len(workers),
+        }
+
+    def stop(self):
+        self._stopping.set()
+        for worker in self.workers:
+            if worker.process and worker.process.poll() is None:
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process:
+                try:
+                    worker.process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    worker.process.kill()
+
+# ====================== 分发器 ======================
+def _error(code, message):
+    return jsonify({'code': code, 'message': message}), code
+
+def _forward(worker, path, body=None, method='GET', query='', skip_headers=()):
+    """把请求转发到指定工作进程，返回 urllib 响应对象（HTTP 错误码也作为响应返回）
+
+    需要由分发器解析响应体时用 skip_headers 去掉 Accept-Encoding，取未压缩的内容
+    """
+    headers = {
+        name: request.headers[name] for name in FORWARDED_HEADERS
+        if name in request.headers and name not in skip_headers
+    }
+    url = worker.base_url + path + (f'?{query}' if query else '')
+    req = urllib.request.Request(url, data=body, headers=headers, method=method)
+    try:
+        return urllib.request.urlopen(req, timeout=PROXY_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        return e
+
+def _response_from(upstream, release=None):
+    """把工作进程的响应按行流式转发给客户端（NDJSON 流逐行刷新）"""
+    def body():
+        try:
+            while True:
+                line = upstream.readline()
+                if not line:
+                    break
+                yield line
+        finally:
+            upstream.close()
+            if release:
+                release()
+    content_type = upstream.headers.get('Content-Type', 'application/json')
+    headers = {name: upstream.headers[name] for name in PASSED_RESPONSE_HEADERS if name in upstream.headers}
+    return Response(body(), status=upstream.status, content_type=content_type, headers=headers)
+
+def _label_sample(line, worker_index):
+    """给一行 Prometheus 样本加上 worker 标签"""
+    name, _, value = line.rpartition(' ')
+    label = f'worker="{worker_index}"'
+    if name.endswith('}'):
+        return f'{name[:-1]},{label}}} {value}'
+    return f'{name}{{{label}}} {value}'
+
+def create_dispatcher(supervisor):
+    app = Flask('dispatcher')
+    app.config['JSON_AS_ASCII'] = False
+    executor = ThreadPoolExecutor(max_workers=max(8, len(supervisor.workers) * 4), thread_name_prefix='dispatch')
+
+    def proxy(path, weight=1):
+        """转发到未完成工作量最少的工作进程；连接被拒绝（请求未送达）时换一个进程重试"""
+        body = request.get_data() if request.method != 'GET' else None
+        tried = []
+        while True:
+            worker = supervisor.acquire(weight, exclude=tried)
+            if worker is None:
+                return _error(503, '没有可用的工作进程')
+            try:
+                upstream = _forward(worker, path, body, request.method, request.query_string.decode())
+            except (urllib.error.URLError, OSError) as e:
+                supervisor.release(worker, weight)
+                logger.warning(f"转发到工作进程 {worker.index} 失败: {e}")
+                # 请求可能已送达并导致进程退出，不再转发给其他进程
+                if not isinstance(getattr(e, 'reason', e), ConnectionRefusedError):
+                    return _error(502, f'工作进程 {worker.index} 请求失败: {e}')
+                tried.append(worker)
+                continue
+            return _response_from(upstream, lambda: supervisor.release(worker, weight))
+
+    def split_batch(query_type, items):
+        """按条目把批量查询拆到多个工作进程并发执行，按原顺序合并结果"""
+        plan = supervisor.assign(len(items))
+        if not plan:
+            return _error(503, '没有可用的工作进程')
+
+        body_path = f'/cyber/{query_type}'
+        # 子请求取未压缩的 JSON，由分发器合并后再按客户端要求的格式和压缩方式输出
+        headers = {
+            name: request.headers[name] for name in FORWARDED_HEADERS
+            if name in request.headers and name != 'Accept-Encoding'
+        }
+
+        def send(worker, indices):
+            try:
+                req = urllib.request.Request(
+                    worker.base_url + body_path,
+                    data=json.dumps([items[idx] for idx in indices], ensure_ascii=False).encode('utf-8'),
+                    headers=dict(headers, **{'Content-Type': 'application/json'}),
+                    method='POST'
+                )
+                with urllib.request.urlopen(req, timeout=PROXY_TIMEOUT) as response:
+                    return indices, json.loads(response.read().decode('utf-8'))
+            except urllib.error.HTTPError as e:
+                return indices, json.loads(e.read().decode('utf-8') or '{}')
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                return indices, {'code': 502, 'message': f'工作进程 {worker.index} 请求失败: {e}'}
+            finally:
+                supervisor.release(worker, len(indices))
+
+        results = [None] * len(items)
+        for indices, payload in executor.map(lambda entry: send(*entry), plan):
+            code = payload.get('code')
+            if code != 900:
+                return jsonify(payload), code if isinstance(code, int) and 400 <= code < 600 else 502
+            for idx, value in zip(indices, payload['data']):
+                results[idx] = value
+        return render(
+            {'code': 900, 'data': results},
+            request.args.get('format'),
+            request.headers.get('Accept-Encoding'),
+            batch=True
+        )
+
+    @app.route('/cyber/workers', methods=['GET'])
+    def workers():
+        """各工作进程的健康状态"""
+        return jsonify({'code': 900, 'data': supervisor.health()})
+
+    @app.route('/cyber/health', methods=['GET'])
+    def health():
+        """至少有一个工作进程就绪时分发器才算就绪"""
+        state = supervisor.health()
+        if not state['available']:
+            return jsonify({'code': 503, 'message': '没有就绪的工作进程', 'data': state}), 503
+        return jsonify({'code': 900, 'data': state})
+
+    @app.route('/cyber/<any(glcx, zzcx, plgjcx):query_type>', methods=['POST'])
+    def query(query_type):
+        data = request.get_json(silent=True)
+        stream = request.args.get('stream') in ('1', 'true')
+        if query_type in SPLIT_QUERY_TYPES and isinstance(data, list) and len(data) > 1 and not stream:
+            return split_batch(query_type, data)
+        weight = len(data) if isinstance(data, list) else len((data or {}).get('id_no_list') or []) or 1
+        return proxy(request.path, weight)
+
+    @app.route('/cyber/metrics', methods=['GET'])
+    def metrics():
+        """合并各工作进程的指标，样本加上 worker 标签，同名指标的样本连续输出"""
+        families = {}
+        for worker in supervisor.workers:
+            if not worker.available:
+                continue
+            try:
+                with urllib.request.urlopen(worker.base_url + '/cyber/metrics', timeout=HEALTH_TIMEOUT) as response:
+                    text = response.read().decode('utf-8')
+            except (urllib.error.URLError, OSError):
+                continue
+            family = None
+            for line in text.splitlines():
+                if line.startswith('# HELP '):
+                    family = families.setdefault(line.split(' ')[2], {'meta': [], 'samples': []})
+                    if not family['meta']:
+                        family['meta'].append(line)
+                elif line.startswith('# TYPE '):
+                    if len(family['meta']) < 2:
+                        family['meta'].append(line)
+                elif line and family is not None:
+                    family['samples'].append(_label_sample(line, worker.index))
+        text = ''.join(
+            '\n'.join(family['meta'] + family['samples']) + '\n'
+            for family in families.values()
+        )
+        return Response(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @app.route('/cyber/jobs/<query_type>', methods=['POST'])
+    def submit_job(query_type):
+        """任务提交到一个工作进程，任务ID加上进程序号前缀，后续查询按前缀路由"""
+        worker = supervisor.acquire()
+        if worker is None:
+            return _error(503, '没有可用的工作进程')
+        try:
+            upstream = _forward(worker, request.path, request.get_data(), 'POST', skip_headers=('Accept-Encoding',))
+            payload = json.loads(upstream.read().decode('utf-8'))
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            return _error(502, f'工作进程 {worker.index} 请求失败: {e}')
+        finally:
+            supervisor.release(worker)
+        if isinstance(payload.get('data'), dict) and 'id' in payload['data']:
+            payload['data']['id'] = f"{worker.index}-{payload['data']['id']}"
+        return jsonify(payload), upstream.status
+
+    @app.route('/cyber/jobs/<job_id>', methods=['GET'])
+    @app.route('/cyber/jobs/<job_id>/result', methods=['GET'])
+    def job(job_id):
+        """任务状态和结果按任务ID前缀转发；已完成任务的结果（可能是 CSV 或压缩内容）原样转发"""
+        prefix, _, local_id = job_id.partition('-')
+        worker = supervisor.get(int(prefix)) if prefix.isdigit() else None
+        if worker is None or not local_id:
+            return _error(404, '任务不存在或已过期')
+        path = request.path.replace(f'/cyber/jobs/{job_id}', f'/cyber/jobs/{local_id}', 1)
+        is_result = path.endswith('/result')
+        try:
+            upstream = _forward(
+                worker, path, query=request.query_string.decode(),
+                skip_headers=() if is_result else ('Accept-Encoding',)
+            )
+            if is_result and upstream.status == 200:
+                return _response_from(upstream)
+            # 状态、未完成和错误响应都是未压缩的 JSON，需要改写其中的任务ID
+            payload = json.loads(upstream.read().decode('utf-8'))
+        except (urllib.error.URLError, OSError, ValueError):
+            return _error(503, f'任务所在的工作进程 {worker.index} 不可用')
+        if isinstance(payload.get('data'), dict) and payload['data'].get('id') == local_id:
+            payload['data']['id'] = job_id
+        return jsonify(payload), upstream.status
+
+    @app.route('/cyber/<path:path>', methods=['GET', 'POST'])
+    def passthrough(path):
+        return proxy(request.path)
+
+    @app.errorhandler(404)
+    def not_found(e):
+        return _error(404, '请求的资源不存在')
+
+    @app.errorhandler(405)
+    def method_not_allowed(e):
+        return _error(405, '请求方法不允许')
+
+    return app
+
+def run_supervisor(workers, host, port, script, worker_args=()):
+    """启动工作进程和前置分发器，分发器退出时停止全部工作进程"""
+    supervisor = Supervisor(workers, port, script, worker_args)
+    supervisor.start()
+    try:
+        create_dispatcher(supervisor).run(host=host, port=port, threaded=True)
+    finally:
+        supervisor.stop()